@@ -0,0 +1,70 @@
+"""
+Speed and accuracy comparison between the built in blend kernels and the blend_modes package
+Run with: python BlendBenchmark.py [size]
+"""
+import sys
+import time
+import numpy as np
+
+from Main import BLEND_MODE_MAP
+
+try:
+    import blend_modes
+except ImportError:
+    print("blend_modes is not installed, install it to run the comparison")
+    sys.exit(1)
+
+BLEND_MODES_FUNCTIONS = {
+    "normal": blend_modes.normal,
+    "multiply": blend_modes.multiply,
+    "overlay": blend_modes.overlay,
+    "darken": blend_modes.darken_only,
+    "lighten": blend_modes.lighten_only,
+    "difference": blend_modes.difference,
+    "addition": blend_modes.addition,
+    "subtract": blend_modes.subtract,
+    "divide": blend_modes.divide,
+    "hard_light": blend_modes.hard_light,
+    "soft_light": blend_modes.soft_light,
+    "dodge": blend_modes.dodge,
+    "grain_extract": blend_modes.grain_extract,
+    "grain_merge": blend_modes.grain_merge,
+}
+
+def timeIt(function, repeats=3):
+    """
+    Returns the best time of a few runs in milliseconds
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def main(size):
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 256, (size, size, 4), dtype=np.uint8)
+    top = rng.integers(0, 256, (size, size, 4), dtype=np.uint8)
+    out = np.empty_like(base)
+    opacity = 200 / 255
+
+    print(f"{size}x{size} RGBA, opacity {opacity:.2f}")
+    print(f"{'mode':<14}{'blend_modes':>14}{'built in':>12}{'speedup':>10}{'max diff':>10}")
+    for name, kernel in BLEND_MODE_MAP.items():
+        reference = BLEND_MODES_FUNCTIONS[name]
+
+        def oldPath():
+            # The float32 path the canvas used to take
+            blended = reference(base.astype(np.float32), top.astype(np.float32), opacity)
+            return np.clip(blended, 0, 255).astype(np.uint8)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            expected = oldPath()
+            oldTime = timeIt(oldPath)
+        newTime = timeIt(lambda: kernel(base, top, opacity, out=out))
+        difference = np.abs(expected.astype(np.int16) - out.astype(np.int16)).max()
+        print(f"{name:<14}{oldTime:>12.1f}ms{newTime:>10.1f}ms{oldTime / newTime:>9.1f}x{difference:>10}")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2048)
@@ -2,39 +2,152 @@ import sys
 import os
 import math
 import time
+import zlib
+import tempfile
+import weakref
+from functools import lru_cache, partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
 import numpy as np
 import cv2
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QMenuBar, QToolBar, QDockWidget, QWidget,
     QVBoxLayout, QHBoxLayout, QPushButton, QLineEdit, QListWidget, QColorDialog,
     QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QFileDialog, QDialog, 
-    QLabel, QSlider, QStackedWidget, QTabWidget, QComboBox, QMessageBox,
-QGraphicsRectItem, QGraphicsPathItem
+    QLabel, QSlider, QStackedWidget, QTabWidget, QComboBox, QMessageBox, QInputDialog,
+QGraphicsRectItem, QGraphicsPathItem, QGraphicsItem
 )
 from PyQt6.QtGui import (QAction, QActionGroup, QPixmap, QMouseEvent, QPen, QPainter, QFont, QColor, QImage, QBrush, QPainterPath,
     QPolygonF, QTransform
 )
-from PyQt6.QtCore import Qt, QRectF, QPointF, QLineF, QTimer
-from PIL import Image, ImageQt, ImageDraw, ImageChops
-from blend_modes import soft_light, lighten_only, dodge, addition, darken_only, multiply, hard_light, difference, subtract, grain_extract, grain_merge, divide, overlay, normal
+from PyQt6.QtCore import Qt, QRectF, QPointF, QLineF, QTimer, QObject, pyqtSignal
+from PIL import Image, ImageDraw
+
+# --- Blend Engine ---
+# Fixed point uint8 blend kernels, matching the blend_modes package to within 1 per channel.
+# Colours are mixed with 15 bit ratios looked up from 256x256 tables, so the layers never
+# need float copies and every kernel can write straight into a preallocated buffer.
+# All four channels are processed together since contiguous arrays are much faster than
+# RGB slices, and the alpha channel is overwritten at the end.
+RATIO_BITS = 15
+COLOUR_BITS = 4
+
+@lru_cache(maxsize=16)
+def normalTables(opacity):
+    """
+    Returns the top layer weight, output alpha and empty pixel tables for normal blending,
+    indexed by (base alpha, top alpha) at the given 0-255 opacity
+    """
+    baseAlpha = np.arange(256, dtype=np.int64)[:, None]
+    topAlpha = np.arange(256, dtype=np.int64)[None, :] * opacity
+    topWeight = topAlpha * 255
+    totalWeight = topWeight + baseAlpha * (65025 - topAlpha)
+    topRatio = (topWeight << RATIO_BITS) // np.maximum(totalWeight, 1)
+    return topRatio.astype(np.int32).ravel(), (totalWeight // 65025).astype(np.uint8).ravel(), (totalWeight == 0).ravel()
+
+@lru_cache(maxsize=16)
+def composeTable(opacity, bits):
+    """
+    Returns the ratio used to mix a blended colour with the base,
+    indexed by (base alpha, min(base alpha, top alpha)) at the given 0-255 opacity
+    """
+    baseAlpha = np.arange(256, dtype=np.int64)[:, None]
+    compAlpha = np.arange(256, dtype=np.int64)[None, :] * opacity
+    newAlpha = baseAlpha * 65025 + (255 - baseAlpha) * compAlpha
+    ratio = ((compAlpha * 255) << bits) // np.maximum(newAlpha, 1)
+    return ratio.astype(np.int32 if bits <= RATIO_BITS else np.int64).ravel()
+
+def pairIndex(first, second):
+    """
+    Packs two uint8 arrays into one uint16 array for 256x256 table lookups
+    """
+    index = first.astype(np.uint16)
+    index <<= 8
+    index |= second
+    return index
+
+def blendNormal(base, top, opacity, out=None):
+    """
+    Places the top layer over the base with standard alpha compositing
+    """
+    if out is None:
+        out = np.empty_like(base)
+    ratioTable, alphaTable, emptyTable = normalTables(int(round(opacity * 255)))
+    alphaIndex = pairIndex(base[..., 3], top[..., 3])
+    topRatio = np.take(ratioTable, alphaIndex)[..., None]
+
+    colour = top.astype(np.int32)
+    colour -= base
+    colour *= topRatio
+    colour >>= RATIO_BITS
+    colour += base
+    out[...] = colour
+    out[..., 3] = np.take(alphaTable, alphaIndex)
+    empty = np.take(emptyTable, alphaIndex)
+    if empty.any():
+        out[empty] = 0
+    return out
+
+def separableBlend(formula):
+    """
+    Builds a kernel for a blend mode that works on each colour channel separately.
+    The formula takes normalised (base, top) colours and is only run once, to fill a 256x256 table
+    """
+    tables = []
+
+    def blendFunction(base, top, opacity, out=None):
+        if not tables:
+            grid = np.arange(256, dtype=np.float64) / 255.0
+            with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+                comp = np.nan_to_num(formula(grid[:, None], grid[None, :]), nan=0.0) * 255.0
+            # Tables too large for 32 bit maths are mixed in 64 bit with a finer ratio
+            wide = np.abs(comp).max() * (1 << (RATIO_BITS + COLOUR_BITS)) >= 2 ** 31
+            tables.append((np.rint(comp * (1 << COLOUR_BITS)).astype(np.int64 if wide else np.int32).ravel(), wide))
+        colourTable, wide = tables[0]
+
+        if out is None:
+            out = np.empty_like(base)
+        ratioBits = 2 * RATIO_BITS if wide else RATIO_BITS
+        ratioTable = composeTable(int(round(opacity * 255)), ratioBits)
+        ratio = np.take(ratioTable, pairIndex(base[..., 3], np.minimum(base[..., 3], top[..., 3])))[..., None]
+
+        colour = np.take(colourTable, pairIndex(base, top))
+        baseColour = base.astype(colourTable.dtype)
+        baseColour <<= COLOUR_BITS
+        colour -= baseColour
+        colour *= ratio
+        colour >>= ratioBits
+        colour += baseColour
+        colour >>= COLOUR_BITS
+        np.clip(colour, 0, 255, out=colour)
+        alpha = base[..., 3].copy()
+        out[...] = colour
+        out[..., 3] = alpha
+        return out
+
+    return blendFunction
 
 BLEND_MODE_MAP = {
-    "normal": normal,
-    "multiply": multiply,
-    "overlay": overlay,
-    "darken": darken_only,
-    "lighten": lighten_only,
-    "difference": difference,
-    "addition": addition,
-    "subtract": subtract,
-    "divide": divide,
-    "hard_light": hard_light,
-    "soft_light": soft_light,
-    "dodge": dodge,
-    "grain_extract": grain_extract,
-    "grain_merge": grain_merge,
+    "normal": blendNormal,
+    "multiply": separableBlend(lambda base, top: np.clip(base * top, 0.0, 1.0)),
+    "overlay": separableBlend(lambda base, top: np.where(base < 0.5, 2 * base * top, 1 - 2 * (1 - base) * (1 - top))),
+    "darken": separableBlend(np.minimum),
+    "lighten": separableBlend(np.maximum),
+    "difference": separableBlend(lambda base, top: np.abs(base - top)),
+    "addition": separableBlend(lambda base, top: base + top),
+    # blend_modes subtracts the normalised layer from the unnormalised image; kept so documents look the same
+    "subtract": separableBlend(lambda base, top: 255.0 * base - top),
+    "divide": separableBlend(lambda base, top: np.minimum((256.0 / 255.0 * base) / (1.0 / 255.0 + top), 1.0)),
+    "hard_light": separableBlend(lambda base, top: np.where(top > 0.5, np.minimum(1 - (1 - base) * (1 - (top - 0.5) * 2), 1.0), np.minimum(base * top * 2, 1.0))),
+    "soft_light": separableBlend(lambda base, top: (1 - base) * base * top + base * (1 - (1 - base) * (1 - top))),
+    "dodge": separableBlend(lambda base, top: np.minimum(base / (1 - top), 1.0)),
+    "grain_extract": separableBlend(lambda base, top: np.clip(base - top + 0.5, 0.0, 1.0)),
+    "grain_merge": separableBlend(lambda base, top: np.clip(base + top - 0.5, 0.0, 1.0)),
 }
 
+TILE_SIZE = 256
+
 # --- Startup Dialog ---
 class StartupDialog(QDialog):
     """
@@ -124,6 +237,67 @@ def tickSpacing(zoom):
     else:
         return 500
 
+def unionRect(first, second):
+    """
+    Global function returning the bounding box covering two (x0, y0, x1, y1) boxes
+    Empty boxes are ignored
+    """
+    if not first or first[0] >= first[2] or first[1] >= first[3]:
+        return second
+    if not second or second[0] >= second[2] or second[1] >= second[3]:
+        return first
+    return (min(first[0], second[0]), min(first[1], second[1]), max(first[2], second[2]), max(first[3], second[3]))
+
+# --- Brush Tips ---
+TIP_CACHE_BYTES = 64 * 1024 * 1024
+
+@lru_cache(maxsize=32)
+def loadTipMask(path):
+    """
+    Global function reading a brush tip file as a greyscale mask, shared by every canvas
+    """
+    with Image.open(path) as image:
+        return image.convert("L")
+
+def prepareTip(mask, size, opacity, colour, resample):
+    """
+    Global function scaling a tip mask and colouring it, with the opacity folded into its alpha
+    """
+    resized = mask.resize((size, size), resample)
+    alpha = resized.point([int(p * (opacity / 255)) for p in range(256)])
+    tip = Image.new("RGBA", resized.size, tuple(colour[:3]) + (0,))
+    tip.putalpha(alpha)
+    return tip
+
+class TipCache:
+    """
+    Least recently used store of prepared brush tips, shared by every canvas.
+    The oldest tips are dropped once the total size goes over the byte budget
+    """
+    def __init__(self, maxBytes=TIP_CACHE_BYTES):
+        self.maxBytes = maxBytes
+        self.tips = OrderedDict()
+        self.totalBytes = 0
+
+    def get(self, key, build):
+        """
+        Returns the tip for the key, building it with build() if it is not cached
+        """
+        tip = self.tips.get(key)
+        if tip is not None:
+            self.tips.move_to_end(key)
+            return tip
+
+        tip = build()
+        self.tips[key] = tip
+        self.totalBytes += tip.width * tip.height * 4
+        while self.totalBytes > self.maxBytes and len(self.tips) > 1:
+            _, oldest = self.tips.popitem(last=False)
+            self.totalBytes -= oldest.width * oldest.height * 4
+        return tip
+
+BRUSH_TIPS = TipCache()
+
 # --- Custom Scene for Grid and Rulers ---
 class CustomScene(QGraphicsScene):
     """
@@ -180,68 +354,961 @@ class CustomScene(QGraphicsScene):
             font = QFont("Arial", int(8 / self.zoomScale))
             painter.setFont(font)
 
+            # The ruler sits on the edges of the visible area, not the repainted rect, so partial repaints line up with it
+            device = QRectF(0, 0, painter.device().width(), painter.device().height())
+            visible = painter.worldTransform().inverted()[0].mapRect(device)
+
             step = spacing
             start_x = math.floor(rect.left() / step) * step
             x = start_x
             while x < rect.right():
                 height = 10 if spacing <= 10 or int(x) % (spacing * 5) == 0 else 6 if int(x) % spacing == 0 else 3
-                painter.drawLine(QLineF(x, rect.top(), x, rect.top() + height))
+                painter.drawLine(QLineF(x, visible.top(), x, visible.top() + height))
                 if rulerNum and int(x) % (spacing * 5) == 0:
-                    painter.drawText(QPointF(x + 2, rect.top() + 10), str(int(x)))
+                    painter.drawText(QPointF(x + 2, visible.top() + 10), str(int(x)))
                 x += step
 
             start_y = math.floor(rect.top() / step) * step
             y = start_y
             while y < rect.bottom():
                 height = 10 if spacing <= 10 or int(y) % (spacing * 5) == 0 else 6 if int(y) % spacing == 0 else 3
-                painter.drawLine(QLineF(rect.left(), y, rect.left() + height, y))
+                painter.drawLine(QLineF(visible.left(), y, visible.left() + height, y))
                 if rulerNum and int(y) % (spacing * 5) == 0:
-                    painter.drawText(QPointF(rect.left() + 12, y + 4), str(int(y)))
+                    painter.drawText(QPointF(visible.left() + 12, y + 4), str(int(y)))
                 y += step
 
+def arrayToQImage(array):
+    """
+    Global function wrapping a contiguous RGBA uint8 array in a QImage without copying it.
+    The array has to outlive the image
+    """
+    height, width = array.shape[:2]
+    return QImage(array.data, width, height, array.strides[0], QImage.Format.Format_RGBA8888)
+
 # --- Layer Class ---
 class Layer:
     """
     Represents a single layer on the canvas
+    Pixels live in one contiguous RGBA NumPy buffer; pil_image is a view onto the same memory
     """
     def __init__(self, name, pil_image, layerOpacity=255, blendMode =  "normal"):
         self.name = name
+        self.pixels = None
+        self.pilView = None
+        self.snapshots = weakref.WeakSet()
         self.pil_image = pil_image
         self.opacity = layerOpacity
         self.blendMode = blendMode
-        self.qt_pixmap = QPixmap.fromImage(ImageQt.ImageQt(pil_image))
-        self.graphicsItem = None  # To be set when added to the canvas
+        self.canvas = None  # To be set when added to the canvas
         self.clippingMaskEnabled = False
+        self.contentBox = None
+        self.alphaCache = None
 
-    def updatePixmap(self, below=None):
-        base = self.pil_image
+    def bounds(self):
+        """
+        Returns a box inside the layer holding all the visible pixels, cached until the layer changes
+        """
+        if self.contentBox is None:
+            self.contentBox = self.pil_image.getbbox() or (0, 0, 0, 0)
+        return self.contentBox
 
-        topImage = base.convert("RGBA")
-        below = below.convert("RGBA") if below else None
+    @property
+    def pil_image(self):
+        """
+        A PIL image sharing memory with the pixel buffer, so drawing on it edits the layer in place
+        """
+        return self.pilView
 
-        topArray = np.array(topImage).astype(np.float32)
+    @pil_image.setter
+    def pil_image(self, image):
+        if image is self.pilView:
+            return
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        self.setPixels(np.array(image))
 
-        # Apply opacity to alpha channel before blending
-        topArray[..., 3] *= self.opacity / 255.0
+    def setPixels(self, pixels):
+        """
+        Replaces the pixel buffer and rebuilds the PIL view onto it
+        """
+        self.pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        height, width = self.pixels.shape[:2]
+        view = Image.frombuffer("RGBA", (width, height), self.pixels, "raw", "RGBA", 0, 1)
+        # frombuffer marks shared memory read only, which would make PIL copy it on the first edit
+        view.readonly = 0
+        self.pilView = view
+        self.alphaCache = None
+        # Snapshots keep the old buffer, which is never written again
+        self.snapshots = weakref.WeakSet()
+
+    def snapshot(self):
+        """
+        Returns a copy-on-write snapshot of the layer's pixels, which costs nothing until the layer is written
+        """
+        return LayerSnapshot(self)
 
-        if below is not None:
-            baseArray = np.array(below).astype(np.float32)
+    def prepareWrite(self, rect=None):
+        """
+        Must be called before writing into the pixel buffer in place, so snapshots can keep
+        the old contents of the tiles in the rectangle (the whole layer if None)
+        """
+        for snapshot in list(self.snapshots):
+            snapshot.preserve(rect)
+
+    def alphaPlane(self):
+        """
+        Returns the layer's alpha as a contiguous uint8 plane for layers clipped to this one,
+        cached until the layer changes or stops being clipped to
+        """
+        if self.alphaCache is None:
+            self.alphaCache = np.ascontiguousarray(self.pixels[..., 3])
+        return self.alphaCache
+
+    def refreshAlpha(self, rect=None):
+        """
+        Brings the cached alpha plane up to date inside the rectangle, or drops it entirely
+        """
+        if self.alphaCache is None:
+            return
+        if rect is None:
+            self.alphaCache = None
+            return
+        height, width = self.alphaCache.shape
+        x0, y0 = max(0, int(rect[0])), max(0, int(rect[1]))
+        x1, y1 = min(width, int(math.ceil(rect[2]))), min(height, int(math.ceil(rect[3])))
+        if x0 < x1 and y0 < y1:
+            self.alphaCache[y0:y1, x0:x1] = self.pixels[y0:y1, x0:x1, 3]
+
+    def displayPixels(self, x0, y0, x1, y1):
+        """
+        Returns the pixels to show inside the rectangle, with any stroke still being drawn merged in
+        """
+        stroke = self.canvas.strokeBuffer if self.canvas else None
+        if stroke is not None and stroke.layer is self:
+            return stroke.apply(self.pixels, x0, y0, x1, y1)
+        return self.pixels[y0:y1, x0:x1]
+
+    def updatePixmap(self, rect=None):
+        """
+        Tells the canvas this layer has changed so the damaged area gets recomposited.
+        Without a rectangle, the damage is the old and new visible areas of the layer
+        """
+        self.refreshAlpha(rect)
+        oldBox = self.contentBox
+        if rect is not None and oldBox is not None:
+            # New pixels can only appear inside the damaged rectangle, so grow the box instead of rescanning.
+            # The rectangle is clipped to the layer first so the box can always be used as a slice
+            height, width = self.pixels.shape[:2]
+            x0, y0 = max(0, int(rect[0])), max(0, int(rect[1]))
+            x1, y1 = min(width, int(math.ceil(rect[2]))), min(height, int(math.ceil(rect[3])))
+            self.contentBox = unionRect(oldBox, (x0, y0, x1, y1))
+        else:
+            self.contentBox = None
+        if self.canvas:
+            if rect is None and oldBox is not None:
+                rect = unionRect(oldBox, self.bounds())
+            self.canvas.updateLayerOrder(rect, self)
+
+class LayerSnapshot:
+    """
+    Copy-on-write view of a layer's pixels as they were when it was taken.
+    Taking one copies nothing. The layer hands over a tile's old contents just before it first writes
+    to it, so only tiles that actually get written are ever duplicated
+    """
+    def __init__(self, layer):
+        self.layer = layer
+        self.base = layer.pixels
+        self.saved = {}
+        layer.snapshots.add(self)
+
+    def preserve(self, rect=None):
+        """
+        Keeps a copy of every tile in the rectangle (the whole layer if None) that is about to be written
+        """
+        if self.base is not self.layer.pixels:
+            return  # The layer has moved to a new buffer, so the old one is never written again
+        height, width = self.base.shape[:2]
+        if rect is None:
+            rect = (0, 0, width, height)
+        x0, y0 = max(0, int(rect[0])), max(0, int(rect[1]))
+        x1, y1 = min(width, int(math.ceil(rect[2]))), min(height, int(math.ceil(rect[3])))
+        for ty in range(y0 // TILE_SIZE * TILE_SIZE, y1, TILE_SIZE):
+            for tx in range(x0 // TILE_SIZE * TILE_SIZE, x1, TILE_SIZE):
+                if (tx, ty) not in self.saved:
+                    self.saved[(tx, ty)] = self.base[ty:ty + TILE_SIZE, tx:tx + TILE_SIZE].copy()
+
+    def changedTiles(self):
+        """
+        Returns the tiles that may differ from the layer now
+        """
+        if self.base is self.layer.pixels:
+            return list(self.saved)
+        height, width = self.base.shape[:2]
+        return [(tx, ty) for ty in range(0, height, TILE_SIZE) for tx in range(0, width, TILE_SIZE)]
+
+    def tile(self, key):
+        tile = self.saved.get(key)
+        if tile is None:
+            tx, ty = key
+            tile = self.base[ty:ty + TILE_SIZE, tx:tx + TILE_SIZE]
+        return tile
+
+    def region(self, rect):
+        """
+        Returns a new array holding the snapshot's pixels inside the rectangle, clipped to the layer
+        """
+        height, width = self.base.shape[:2]
+        x0, y0 = max(0, int(rect[0])), max(0, int(rect[1]))
+        x1, y1 = min(width, int(math.ceil(rect[2]))), min(height, int(math.ceil(rect[3])))
+        pixels = self.base[y0:y1, x0:x1].copy()
+        for (tx, ty), tile in self.saved.items():
+            ix0, iy0 = max(x0, tx), max(y0, ty)
+            ix1, iy1 = min(x1, tx + tile.shape[1]), min(y1, ty + tile.shape[0])
+            if ix0 < ix1 and iy0 < iy1:
+                pixels[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = tile[iy0 - ty:iy1 - ty, ix0 - tx:ix1 - tx]
+        return pixels
+
+    def array(self):
+        height, width = self.base.shape[:2]
+        return self.region((0, 0, width, height))
+
+    def image(self):
+        """
+        Returns a new PIL image of the snapshot
+        """
+        return Image.fromarray(self.array(), "RGBA")
+
+    def memoryBytes(self):
+        return sum(tile.nbytes for tile in self.saved.values())
+
+    def release(self):
+        """
+        Stops the layer handing tiles to this snapshot
+        """
+        self.layer.snapshots.discard(self)
+        self.saved = {}
+
+# --- Selections ---
+class SelectionMask:
+    """
+    A selection stored as its bounding box and the 0-255 mask inside that box.
+    Everything outside the box is unselected, so combining and reading selections costs the selected area, not the canvas.
+    Masks are never changed once made, each has its own version number for caching
+    """
+    versions = count(1)
+
+    def __init__(self, size, local=None, origin=(0, 0)):
+        self.size = size
+        self.version = next(SelectionMask.versions)
+        self.box = None
+        self.local = None
+        if local is not None:
+            self.setLocal(local, origin)
+
+    @classmethod
+    def rectangle(cls, size, rect):
+        """
+        Returns a selection of the (x0, y0, x1, y1) rectangle clipped to the canvas
+        """
+        width, height = size
+        x0, y0 = max(0, int(rect[0])), max(0, int(rect[1]))
+        x1, y1 = min(width, int(rect[2])), min(height, int(rect[3]))
+        if x0 >= x1 or y0 >= y1:
+            return cls(size)
+        return cls(size, np.full((y1 - y0, x1 - x0), 255, dtype=np.uint8), (x0, y0))
+
+    @classmethod
+    def polygon(cls, size, points):
+        """
+        Returns a selection of the polygon, drawn only over the polygon's own bounding box
+        """
+        xs = [point[0] for point in points]
+        ys = [point[1] for point in points]
+        left, top = math.floor(min(xs)), math.floor(min(ys))
+        local = Image.new("L", (math.ceil(max(xs)) - left + 1, math.ceil(max(ys)) - top + 1), 0)
+        ImageDraw.Draw(local).polygon([(x - left, y - top) for x, y in points], fill=255)
+        return cls(size, np.asarray(local), (left, top))
+
+    def setLocal(self, local, origin):
+        """
+        Stores a mask placed at origin, clipped to the canvas and trimmed to its selected pixels
+        """
+        width, height = self.size
+        left, top = origin
+        x0, y0 = max(0, left), max(0, top)
+        x1, y1 = min(width, left + local.shape[1]), min(height, top + local.shape[0])
+        self.box = None
+        self.local = None
+        if x0 >= x1 or y0 >= y1:
+            return
+        local = local[y0 - top:y1 - top, x0 - left:x1 - left]
+        bx, by, bw, bh = cv2.boundingRect(local)
+        if bw == 0 or bh == 0:
+            return
+        self.local = np.ascontiguousarray(local[by:by + bh, bx:bx + bw])
+        self.box = (x0 + bx, y0 + by, x0 + bx + bw, y0 + by + bh)
+
+    def getbbox(self):
+        return self.box
+
+    def getpixel(self, point):
+        x, y = point
+        if self.box is None or not (self.box[0] <= x < self.box[2] and self.box[1] <= y < self.box[3]):
+            return 0
+        return int(self.local[y - self.box[1], x - self.box[0]])
+
+    def region(self, rect):
+        """
+        Returns a new array of the mask inside the rectangle, zero wherever it is unselected
+        """
+        x0, y0, x1, y1 = (int(value) for value in rect)
+        out = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        if self.box is not None:
+            ix0, iy0 = max(x0, self.box[0]), max(y0, self.box[1])
+            ix1, iy1 = min(x1, self.box[2]), min(y1, self.box[3])
+            if ix0 < ix1 and iy0 < iy1:
+                out[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = self.local[iy0 - self.box[1]:iy1 - self.box[1], ix0 - self.box[0]:ix1 - self.box[0]]
+        return out
+
+    def crop(self, rect):
+        """
+        Returns the mask inside the rectangle as a PIL L image
+        """
+        return Image.fromarray(self.region(rect), "L")
+
+    def clearOutside(self, plane, origin=(0, 0)):
+        """
+        Zeroes a plane placed at origin wherever it falls outside the selection, in place
+        """
+        x0, y0 = origin
+        height, width = plane.shape[:2]
+        selected = self.region((x0, y0, x0 + width, y0 + height))
+        plane[selected == 0] = 0
+        return plane
+
+    def combine(self, other, mode):
+        """
+        Returns a new selection joining this one with another, "add" keeps either and "subtract" removes the other.
+        Only the boxes involved are touched
+        """
+        if mode == "add":
+            if other.box is None:
+                return self
+            if self.box is None:
+                return other
+            box = unionRect(self.box, other.box)
+            combined = np.maximum(self.region(box), other.region(box))
+            return SelectionMask(self.size, combined, box[:2])
+        if self.box is None or other.box is None:
+            return self
+        removed = cv2.subtract(self.local, other.region(self.box))
+        return SelectionMask(self.size, removed, self.box[:2])
+
+    def contours(self):
+        """
+        Returns the outline contours of the selection in canvas coordinates
+        """
+        if self.box is None:
+            return []
+        return cv2.findContours(self.local, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE, offset=self.box[:2])[0]
+
+def splitByMask(pixels, mask):
+    """
+    Global function splitting RGBA pixels by a 0-255 mask into the selected part and the part left behind.
+    Colour is kept and only alpha is shared between them, so soft selection edges don't darken
+    """
+    alpha = pixels[..., 3].astype(np.uint16)
+    selected = pixels.copy()
+    selected[..., 3] = (alpha * np.asarray(mask, dtype=np.uint16) + 127) // 255
+    remaining = pixels.copy()
+    remaining[..., 3] = alpha - selected[..., 3]
+    selected[selected[..., 3] == 0] = 0
+    remaining[remaining[..., 3] == 0] = 0
+    return selected, remaining
+
+# --- Selection Outlines ---
+# Outlines cached across all canvases, and selections up to this area are traced without the worker thread
+OUTLINE_CACHE_SIZE = 16
+OUTLINE_SYNC_AREA = 512 * 512
+
+def outlineEpsilon(zoom):
+    """
+    Global function returning how far (in canvas pixels) a simplified outline may stray from the mask,
+    half a screen pixel at the zoom's power of two band so nearby zoom levels share one cached outline
+    """
+    band = 2.0 ** math.floor(math.log2(max(zoom, 1 / 64)))
+    return 0.5 / band
+
+def buildOutline(mask, epsilon):
+    """
+    Global function tracing a selection's outline as a QPainterPath, with each contour simplified to within epsilon
+    """
+    contours = [cv2.approxPolyDP(contour, epsilon, True) if len(contour) > 2 else contour for contour in mask.contours()]
+    contours = [contour for contour in contours if len(contour) >= 2]
+    path = QPainterPath()
+    if not contours:
+        return path
+
+    # Write every point into one polygon straight from numpy, then add each contour as a slice of it
+    points = np.concatenate(contours).reshape(-1, 2).astype(np.float64)
+    polygon = QPolygonF()
+    polygon.resize(len(points))
+    buffer = polygon.data()
+    buffer.setsize(points.nbytes)
+    np.frombuffer(buffer, np.float64).reshape(-1, 2)[:] = points
+
+    start = 0
+    for contour in contours:
+        path.addPolygon(polygon.mid(start, len(contour)))
+        path.closeSubpath()
+        start += len(contour)
+    return path
+
+class OutlineService(QObject):
+    """
+    Builds selection outlines and caches them per mask version and zoom band.
+    Large selections are traced on a worker thread, and ready is emitted on the GUI thread once they are done
+    """
+    ready = pyqtSignal(object)
+    built = pyqtSignal(object, object)
 
-            if topArray.shape[2] != 4 or baseArray.shape[2] != 4:
-                raise ValueError("Both layers must be RGBA format.")
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.cache = OrderedDict()
+        self.pending = set()
+        self.worker = ThreadPoolExecutor(max_workers=1)
+        self.built.connect(self.store)
 
-            blendFunction = BLEND_MODE_MAP.get(self.blend_mode, normal)
-            blendedArray = blendFunction(topArray, baseArray, 1.0)
-            blendedImage = Image.fromarray(np.uint8(np.clip(blendedArray, 0, 255)), mode="RGBA")
+    def outline(self, mask, epsilon):
+        """
+        Returns the outline if it is cached or small enough to trace now, otherwise starts tracing it and returns None
+        """
+        key = (mask.version, epsilon)
+        path = self.cache.get(key)
+        if path is not None:
+            self.cache.move_to_end(key)
+            return path
+        x0, y0, x1, y1 = mask.getbbox()
+        if (x1 - x0) * (y1 - y0) <= OUTLINE_SYNC_AREA:
+            path = buildOutline(mask, epsilon)
+            self.store(key, path, announce=False)
+            return path
+        if key not in self.pending:
+            self.pending.add(key)
+            self.worker.submit(self.trace, mask, key)
+        return None
+
+    def trace(self, mask, key):
+        # Runs on the worker thread, the signal hands the path back to the GUI thread.
+        # A failed trace hands back None so the key stops being pending and can be traced again
+        try:
+            path = buildOutline(mask, key[1])
+        except Exception as error:
+            print(f"[OUTLINE] Tracing failed: {error}")
+            path = None
+        self.built.emit(key, path)
+
+    def store(self, key, path, announce=True):
+        self.pending.discard(key)
+        if path is None:
+            return
+        self.cache[key] = path
+        while len(self.cache) > OUTLINE_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        if announce:
+            self.ready.emit(key)
+
+OUTLINES = OutlineService()
+
+# Floating selections larger than this on their long side are previewed from a reduced copy
+FLOATING_PREVIEW_SIZE = 1024
+
+# --- Affine Transforms ---
+TRANSFORM_INTERPOLATION = {
+    "Nearest": cv2.INTER_NEAREST,
+    "Bilinear": cv2.INTER_LINEAR,
+    "Bicubic": cv2.INTER_CUBIC,
+    "Lanczos": cv2.INTER_LANCZOS4,
+}
+
+# warpAffine splits its output rows across this many threads
+cv2.setNumThreads(os.cpu_count() or 1)
+
+def transformMatrix(transform):
+    """
+    Global function returning a QTransform as a 3x3 matrix acting on column vectors
+    """
+    return np.array([[transform.m11(), transform.m21(), transform.dx()],
+                     [transform.m12(), transform.m22(), transform.dy()],
+                     [0.0, 0.0, 1.0]])
+
+def warpRegion(region, mask, box, matrix, interpolation, size):
+    """
+    Global function resampling an RGBA region (and optional L mask) that sat at box through a 3x3 scene matrix
+    with a single cv2.warpAffine, clipped to a canvas of the given (width, height).
+    Returns the warped pixels, warped mask and the scene position of their top left, or None if nothing lands on the canvas.
+    Colour is premultiplied while warping so transparent pixels don't bleed dark edges into the result
+    """
+    x0, y0, x1, y1 = box
+    corners = matrix @ np.array([[x0, x1, x1, x0], [y0, y0, y1, y1], [1, 1, 1, 1]], dtype=np.float64)
+    width, height = size
+    linear = matrix[:2, :2]
+    if np.allclose(np.abs(linear), np.eye(2)) and np.allclose(corners, np.rint(corners)):
+        # Whole pixel moves and flips only reorder pixels, so they are sliced rather than resampled
+        stepX, stepY = int(round(linear[0, 0])), int(round(linear[1, 1]))
+        left, top = int(round(corners[0].min())), int(round(corners[1].min()))
+        outX0, outY0 = max(0, left), max(0, top)
+        outX1, outY1 = min(width, left + (x1 - x0)), min(height, top + (y1 - y0))
+        if outX0 >= outX1 or outY0 >= outY1:
+            return None
+        window = (slice(outY0 - top, outY1 - top), slice(outX0 - left, outX1 - left))
+        warped = np.ascontiguousarray(region[::stepY, ::stepX][window])
+        warpedMask = np.ascontiguousarray(mask[::stepY, ::stepX][window]) if mask is not None else None
+        return warped, warpedMask, (outX0, outY0)
+
+    outX0, outY0 = max(0, math.floor(corners[0].min() + 1e-6)), max(0, math.floor(corners[1].min() + 1e-6))
+    outX1, outY1 = min(width, math.ceil(corners[0].max() - 1e-6)), min(height, math.ceil(corners[1].max() - 1e-6))
+    if outX0 >= outX1 or outY0 >= outY1:
+        return None
+
+    # cv2 puts pixel centres on whole numbers where the scene puts them on halves
+    local = np.array([[1, 0, -outX0 - 0.5], [0, 1, -outY0 - 0.5], [0, 0, 1]]) @ matrix @ np.array([[1, 0, x0 + 0.5], [0, 1, y0 + 0.5], [0, 0, 1]])
+    warp = local[:2]
+    outSize = (outX1 - outX0, outY1 - outY0)
+
+    if interpolation == cv2.INTER_NEAREST:
+        warped = cv2.warpAffine(region, warp, outSize, flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    else:
+        premultiplied = region.astype(np.float32)
+        alpha = premultiplied[..., 3:]
+        premultiplied[..., :3] *= alpha / 255.0
+        premultiplied = cv2.warpAffine(premultiplied, warp, outSize, flags=interpolation, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        alpha = premultiplied[..., 3:]
+        np.clip(alpha, 0, 255, out=alpha)
+        premultiplied[..., :3] *= 255.0 / np.maximum(alpha, 1e-3)
+        np.clip(premultiplied, 0, 255, out=premultiplied)
+        premultiplied += 0.5
+        warped = premultiplied.astype(np.uint8)
+
+    warpedMask = None
+    if mask is not None:
+        warpedMask = cv2.warpAffine(mask, warp, outSize, flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return warped, warpedMask, (outX0, outY0)
+
+# --- Tiled Compositor ---
+class TileCompositor:
+    """
+    Blends the layer stack in fixed size tiles.
+    Every stack position keeps its own tile cache holding the composite of that layer and everything
+    below it, so only damaged tiles ever get reblended.
+    A missing cache entry means the tile is identical to the one below it.
+    Damage remembers the lowest stack position that changed, so editing layer N reuses
+    the cached composite below it and only reblends N and the layers above
+    """
+    def __init__(self, width, height, tileSize=TILE_SIZE):
+        self.width = width
+        self.height = height
+        self.tileSize = tileSize
+        self.stackCache = []
+        self.stackLayers = []
+        self.damage = {}
+        self.output = np.zeros((height, width, 4), dtype=np.uint8)
+
+    def tileRect(self, key):
+        """
+        Returns the canvas rectangle covered by a tile
+        """
+        x0 = key[0] * self.tileSize
+        y0 = key[1] * self.tileSize
+        return (x0, y0, min(x0 + self.tileSize, self.width), min(y0 + self.tileSize, self.height))
+
+    def markDirty(self, rect=None, fromIndex=0):
+        """
+        Flags every tile touching the rectangle (or the whole canvas) for recompositing
+        from the given stack position upwards
+        """
+        if rect is None:
+            rect = (0, 0, self.width, self.height)
+        x0, y0 = max(0, int(rect[0])), max(0, int(rect[1]))
+        x1, y1 = min(self.width, int(math.ceil(rect[2]))), min(self.height, int(math.ceil(rect[3])))
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        size = self.tileSize
+        for ty in range(y0 // size, (y1 - 1) // size + 1):
+            for tx in range(x0 // size, (x1 - 1) // size + 1):
+                tx0, ty0, tx1, ty1 = self.tileRect((tx, ty))
+                dirty = (max(x0, tx0), max(y0, ty0), min(x1, tx1), min(y1, ty1))
+                startIndex = fromIndex
+                old = self.damage.get((tx, ty))
+                if old:
+                    dirty = unionRect(old[0], dirty)
+                    startIndex = min(old[1], fromIndex)
+                self.damage[(tx, ty)] = (dirty, startIndex)
+
+    def syncStack(self, layers):
+        """
+        Compares the layer stack with the one last composited.
+        Caches from the first position that differs upwards are dropped, and only the area
+        covered by the layers that moved, appeared or disappeared is marked dirty
+        """
+        firstChange = 0
+        for old, new in zip(self.stackLayers, layers):
+            if old is not new:
+                break
+            firstChange += 1
+
+        if firstChange == len(self.stackLayers) == len(layers):
+            return
+
+        damaged = None
+        for layer in self.stackLayers[firstChange:] + layers[firstChange:]:
+            damaged = unionRect(damaged, layer.bounds())
+
+        self.stackCache = self.stackCache[:firstChange] + [{} for _ in layers[firstChange:]]
+        self.stackLayers = list(layers)
+        if damaged:
+            self.markDirty(damaged, firstChange)
+
+    def cachedBelow(self, index, key):
+        """
+        Returns the cached tile for everything below the stack position, or None if it is transparent
+        """
+        for position in range(index - 1, -1, -1):
+            tile = self.stackCache[position].get(key)
+            if tile is not None:
+                return tile
+        return None
+
+    def composite(self, layers):
+        """
+        Reblends the damaged part of every dirty tile and returns the rectangles that changed
+        """
+        self.syncStack(layers)
+        if not self.damage:
+            return []
+
+        boxes = [layer.bounds() for layer in layers]
+        changed = []
+        for key, (rect, fromIndex) in self.damage.items():
+            x0, y0, x1, y1 = rect
+            tx0, ty0, tx1, ty1 = self.tileRect(key)
+            local = (slice(y0 - ty0, y1 - ty0), slice(x0 - tx0, x1 - tx0))
+            below = self.cachedBelow(fromIndex, key)
+
+            for index in range(fromIndex, len(layers)):
+                layer = layers[index]
+                cache = self.stackCache[index]
+                box = boxes[index]
+                isEmpty = box[0] >= x1 or box[2] <= x0 or box[1] >= y1 or box[3] <= y0
+
+                if layer.opacity == 0 or isEmpty:
+                    # Nothing to blend, so this position just repeats the one below it
+                    if key in cache:
+                        cache[key][local] = below[local] if below is not None else 0
+                        below = cache[key]
+                    continue
+
+                tile = cache.get(key)
+                if tile is None:
+                    tile = below.copy() if below is not None else np.zeros((ty1 - ty0, tx1 - tx0, 4), dtype=np.uint8)
+                    cache[key] = tile
+
+                baseLayer = below[local] if below is not None else np.zeros((y1 - y0, x1 - x0, 4), dtype=np.uint8)
+                topLayer = layer.displayPixels(x0, y0, x1, y1)
+                blendFunction = BLEND_MODE_MAP.get(layer.blendMode, blendNormal)
+                blendFunction(baseLayer, topLayer, layer.opacity / 255.0, out=tile[local])
+                below = tile
+
+            self.output[y0:y1, x0:x1] = below[local] if below is not None else 0
+            changed.append(rect)
+
+        self.damage.clear()
+        return changed
+
+class CompositeItem(QGraphicsItem):
+    """
+    Shows the compositor output on the scene.
+    Paints straight from a QImage wrapping the output buffer, so only the exposed area is ever drawn
+    """
+    def __init__(self, compositor):
+        super().__init__()
+        self.compositor = compositor
+        self.image = arrayToQImage(compositor.output)
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        return QRectF(0, 0, self.compositor.width, self.compositor.height)
+
+    def paint(self, painter, option, widget=None):
+        rect = option.exposedRect.intersected(self.boundingRect())
+        if not rect.isEmpty():
+            painter.drawImage(rect, self.image, rect)
+
+class StrokeBuffer:
+    """
+    Holds the stroke currently being drawn as the highest dab alpha seen at each pixel,
+    so overlapping dabs never build up past the tool's opacity.
+    Only covers the tiles the stroke has touched, and is merged into its layer once the stroke ends
+    """
+    def __init__(self, layer, colour, erasing):
+        self.layer = layer
+        self.colour = np.array(colour[:3], dtype=np.float32)
+        self.erasing = erasing
+        self.box = None
+        self.alpha = None
+
+    def reserve(self, rect):
+        """
+        Grows the buffer, a whole tile at a time, until it covers the rectangle
+        """
+        height, width = self.layer.pixels.shape[:2]
+        size = TILE_SIZE
+        box = (rect[0] // size * size, rect[1] // size * size,
+               min(width, -(-rect[2] // size) * size), min(height, -(-rect[3] // size) * size))
+        if self.box is not None:
+            box = unionRect(self.box, box)
+            if box == self.box:
+                return
+        alpha = np.zeros((box[3] - box[1], box[2] - box[0]), dtype=np.uint8)
+        if self.box is not None:
+            x0, y0, x1, y1 = self.box
+            alpha[y0 - box[1]:y1 - box[1], x0 - box[0]:x1 - box[0]] = self.alpha
+        self.box = box
+        self.alpha = alpha
+
+    def region(self, x0, y0, x1, y1):
+        """
+        Returns a view of the coverage inside the rectangle, which must already be reserved
+        """
+        return self.alpha[y0 - self.box[1]:y1 - self.box[1], x0 - self.box[0]:x1 - self.box[0]]
+
+    def apply(self, pixels, x0, y0, x1, y1):
+        """
+        Returns the pixels in the rectangle with the stroke merged on top
+        """
+        region = pixels[y0:y1, x0:x1]
+        if self.box is None:
+            return region
+        ix0, iy0 = max(x0, self.box[0]), max(y0, self.box[1])
+        ix1, iy1 = min(x1, self.box[2]), min(y1, self.box[3])
+        if ix0 >= ix1 or iy0 >= iy1:
+            return region
+
+        coverage = self.region(ix0, iy0, ix1, iy1)
+        touched = coverage > 0
+        if not touched.any():
+            return region
+
+        merged = region.copy()
+        target = merged[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0]
+        strokeAlpha = coverage[touched]
+        if self.erasing:
+            alpha = target[..., 3][touched]
+            target[..., 3][touched] = alpha - np.minimum(alpha, strokeAlpha)
         else:
-            blendedImage = Image.fromarray(np.uint8(np.clip(topArray, 0, 255)), mode="RGBA")
+            # Source-over of the stroke colour
+            area = target[touched].astype(np.float32)
+            sourceAlpha = strokeAlpha[:, None].astype(np.float32) / 255.0
+            baseAlpha = area[:, 3:4] / 255.0
+            outAlpha = sourceAlpha + baseAlpha * (1.0 - sourceAlpha)
+            area[:, :3] = (self.colour * sourceAlpha + area[:, :3] * baseAlpha * (1.0 - sourceAlpha)) / outAlpha
+            area[:, 3:4] = outAlpha * 255.0
+            target[touched] = np.clip(area + 0.5, 0, 255).astype(np.uint8)
+        return merged
+
+    def merge(self):
+        """
+        Writes the stroke into the layer's pixels
+        """
+        if self.box is not None:
+            x0, y0, x1, y1 = self.box
+            self.layer.prepareWrite(self.box)
+            self.layer.pixels[y0:y1, x0:x1] = self.apply(self.layer.pixels, x0, y0, x1, y1)
+            self.layer.refreshAlpha(self.box)
+
+# --- Undo History ---
+# The newest history stays as raw pixels up to the first budget, then gets zlib compressed.
+# Once the compressed history passes the second budget, the oldest is moved to a temporary file
+UNDO_MEMORY_LIMIT = 256 * 1024 * 1024
+UNDO_COMPRESSED_LIMIT = 256 * 1024 * 1024
+
+class HistorySpill:
+    """
+    Temporary file holding compressed undo history that no longer fits in memory
+    """
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+
+    def write(self, data):
+        """
+        Appends the data and returns its offset in the file
+        """
+        offset = self.size
+        self.file.seek(offset)
+        self.file.write(data)
+        self.size += len(data)
+        return offset
+
+    def read(self, offset, length):
+        self.file.seek(offset)
+        return self.file.read(length)
 
-        self.qt_pixmap = QPixmap.fromImage(ImageQt.ImageQt(blendedImage))
+    def close(self):
+        self.file.close()
 
-        if self.graphicsItem:
-            self.graphicsItem.setPixmap(self.qt_pixmap)
+class HistoryBuffer:
+    """
+    One saved pixel array in the undo history, kept as is, zlib compressed, or spilled to disk.
+    Compressed and spilled pixels are only read back when the step is undone or redone
+    """
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+        self.packed = None
+        self.spilled = None
+
+    def memoryBytes(self):
+        if self.array is not None:
+            return self.array.nbytes
+        if self.packed is not None:
+            return len(self.packed)
+        return 0
+
+    def diskBytes(self):
+        return self.spilled[2] if self.spilled else 0
+
+    def compress(self):
+        if self.array is not None:
+            self.packed = zlib.compress(self.array.tobytes(), 1)
+            self.array = None
+
+    def spill(self, spillFile):
+        self.compress()
+        if self.packed is not None:
+            self.spilled = (spillFile, spillFile.write(self.packed), len(self.packed))
+            self.packed = None
+
+    def load(self):
+        """
+        Returns the saved pixels, decompressing or reading them back from disk if needed
+        """
+        if self.array is not None:
+            return self.array
+        packed = self.packed
+        if packed is None:
+            spillFile, offset, length = self.spilled
+            packed = spillFile.read(offset, length)
+        return np.frombuffer(zlib.decompress(packed), dtype=np.uint8).reshape(self.shape)
+
+class TileDeltaEntry:
+    """
+    Undo step for one edit to one layer, keeping only the tiles the edit changed.
+    A copy-on-write snapshot is taken when the edit starts, and the tiles written since are compared
+    once it has finished. Swapping the stored tiles with the layer's undoes the edit, and swapping again redoes it
+    """
+    def __init__(self, description, layer):
+        self.description = description
+        self.layer = layer
+        self.before = layer.snapshot()
+        self.tiles = {}
+
+    def finish(self):
+        """
+        Keeps the tiles that differ from the layer now and drops the snapshot.
+        Returns False if the edit changed nothing
+        """
+        if self.before is not None:
+            pixels = self.layer.pixels
+            for tx, ty in self.before.changedTiles():
+                old = self.before.tile((tx, ty))
+                if not np.array_equal(old, pixels[ty:ty + TILE_SIZE, tx:tx + TILE_SIZE]):
+                    self.tiles[(tx, ty)] = HistoryBuffer(old.copy())
+            self.before.release()
+            self.before = None
+        return bool(self.tiles)
+
+    def buffers(self):
+        return self.tiles.values()
+
+    def memoryBytes(self):
+        pending = self.before.memoryBytes() if self.before is not None else 0
+        return pending + sum(buffer.memoryBytes() for buffer in self.tiles.values())
+
+    def swap(self, canvas):
+        """
+        Exchanges the stored tiles with the ones on the layer and recomposites just those tiles
+        """
+        pixels = self.layer.pixels
+        damaged = None
+        for (tx, ty), buffer in self.tiles.items():
+            tile = buffer.load()
+            height, width = tile.shape[:2]
+            self.layer.prepareWrite((tx, ty, tx + width, ty + height))
+            current = pixels[ty:ty + height, tx:tx + width]
+            self.tiles[(tx, ty)] = HistoryBuffer(current.copy())
+            current[...] = tile
+            damaged = unionRect(damaged, (tx, ty, tx + width, ty + height))
+        if damaged:
+            self.layer.updatePixmap(damaged)
+
+class LayerStackEntry:
+    """
+    Undo step for layers being added or removed, holding the layer stack and each layer's settings.
+    No pixels are copied, the Layer objects themselves are kept
+    """
+    def __init__(self, description, state):
+        self.description = description
+        self.state = state
+
+    def finish(self):
+        return True
+
+    def buffers(self):
+        return []
+
+    def memoryBytes(self):
+        """
+        Counts the layers only the history is keeping alive, such as deleted ones
+        """
+        return sum(layer.pixels.nbytes for layer, _ in self.state if layer.canvas is None)
+
+    def swap(self, canvas):
+        """
+        Restores the saved stack, keeping the current one so the step can be redone
+        """
+        current = canvas.snapshotLayers()
+        canvas.restoreLayers(self.state)
+        self.state = current
+
+class CommandEntry:
+    """
+    Undo step for an operation that can be exactly reversed, such as a whole layer flip or a layer setting change.
+    Only the two actions are kept, no pixels
+    """
+    def __init__(self, description, undoAction, redoAction, key=None):
+        self.description = description
+        self.undoAction = undoAction
+        self.redoAction = redoAction
+        self.key = key
+        self.undone = False
+
+    def finish(self):
+        return True
+
+    def buffers(self):
+        return []
+
+    def memoryBytes(self):
+        return 0
+
+    def swap(self, canvas):
+        if self.undone:
+            self.redoAction()
         else:
-            self.graphicsItem = QGraphicsPixmapItem(self.qt_pixmap)
+            self.undoAction()
+        self.undone = not self.undone
 
 class Canvas(QGraphicsView):
     """
@@ -265,7 +1332,13 @@ class Canvas(QGraphicsView):
 
         self.setScene(self.customScene)
 
+        # Everything visible on the canvas comes from one tiled composite of the layer stack
+        self.compositor = TileCompositor(self.sceneWidth, self.sceneHeight)
+        self.compositeItem = CompositeItem(self.compositor)
+        self.customScene.addItem(self.compositeItem)
+
         self.layers = []
+        self.layerPositions = {}
         self.selectedLayerNames = set()
         self.currentLayer = None
 
@@ -279,12 +1352,23 @@ class Canvas(QGraphicsView):
         self.eraserImage = None
         self.brushMask = None
         self.eraserMask = None
+        self.brushPath = None
+        self.eraserPath = None
+        self.pencilPath = None
         self.brushOpacity = 255
         self.eraserOpacity = 255
         self.pencilWidth = 3
         self.pencilOpacity = 255
         self.pencilSpacing = 1
         self.pencilMode = "draw" 
+        self.fillTolerance = 0
+        self.fillMode = "contiguous"
+        self.fillDistance = "rgb"
+        self.wandTolerance = 32
+        self.wandMode = "contiguous"
+        self.wandSample = "layer"
+        self.wandAntiAlias = True
+        self.transformInterpolation = "Bicubic"
         self.pencilMask = None
         self.pencilImage = None
 
@@ -293,6 +1377,12 @@ class Canvas(QGraphicsView):
         self.lastStampPos = None
         self.strokeBuffer = None
 
+        # Dab damage is collected here and pushed to the screen at most once per monitor refresh
+        self.pendingDamage = None
+        self.displayTimer = QTimer(self)
+        self.displayTimer.setSingleShot(True)
+        self.displayTimer.timeout.connect(self.flushDisplayUpdate)
+
         self.zoomFactor = 1.0
         self.currentZoom = 100
         self.moveLastMousePos = None
@@ -305,29 +1395,41 @@ class Canvas(QGraphicsView):
         self.selectionStartPoint = None
         self.isSelectionDragging = False
         self.selectionLineDashes = 0
-        self.selectionLineAnimation = QTimer()
+        self.selectionLineAnimation = QTimer(self)
         self.selectionLineAnimation.setInterval(100)
         self.selectionLineAnimation.timeout.connect(self.animateSelection)
-        self.selectionLineAnimation.start()
         self.lassoPoints = []
         self.lassoPathItem = None
+        self.lassoDrawn = 0
+        self.lassoCone = None
+        self.lassoTimer = QTimer(self)
+        self.lassoTimer.setSingleShot(True)
+        self.lassoTimer.timeout.connect(self.flushLassoPreview)
+        self.outlineEpsilon = outlineEpsilon(self.zoomFactor)
+        OUTLINES.ready.connect(self.onOutlineReady)
         
         self.isSelectionMoving = False
         self.selectionStartPoint = None
-        self.selectionMovedBackup = None
-        self.selectionMovedMask = None
         self.selectionDragOffset = (0, 0)
+        self.floatingItem = None
+        self.floatingRegion = None
+        self.floatingMask = None
+        self.floatingBox = None
+        self.floatingSnapshot = None
+        self.floatingScale = 1
         self.transformationHandles = []
         self.currentHandle = None
         self.transformBoundingBox = None
-        self.transformOriginal = None
         self.transformationMode = None
-        self.rotationBackup = None
+        self.handleOrigins = []
         self.pointOfRotation = None
         self.rotationStartAngle = None
 
         self.undoStack = []
         self.redoStack = []
+        self.undoMemoryLimit = UNDO_MEMORY_LIMIT
+        self.undoCompressedLimit = UNDO_COMPRESSED_LIMIT
+        self.undoSpill = None
 
         self.setRenderHint(QPainter.RenderHint.Antialiasing)
         self.setTransformationAnchor(QGraphicsView.ViewportAnchor.AnchorUnderMouse)
@@ -336,6 +1438,7 @@ class Canvas(QGraphicsView):
 
         self.shapeStartPoint = None
         self.shapePreviewBuffer = None
+        self.shapeRect = None
         
         self.loadBrushImage("brushes/01.png")
         self.loadEraserImage("brushes/01.png")
@@ -350,12 +1453,10 @@ class Canvas(QGraphicsView):
         if not os.path.exists(path):
             print(f"Brush image not found: {path}")
             return
-        baseImg = Image.open(path).convert("L")
-        mask = mask = baseImg.convert("L")
-        self.brushMask = mask
+        self.brushPath = path
+        self.brushMask = loadTipMask(path)
         self.updateBrush()
 
-        
     def updateBrush(self):
         """
         Updates brush based off of inputs
@@ -363,16 +1464,9 @@ class Canvas(QGraphicsView):
         if self.brushMask is None:
             return
 
-        scaledSize = (self.penWidth, self.penWidth)
-        resizedMask = self.brushMask.resize(scaledSize, Image.LANCZOS)
-
-
-        alpha = resizedMask.point(lambda p: int(p * (self.brushOpacity / 255)))
-
-        coloured = Image.new("RGBA", resizedMask.size, self.penColour[:3] + (0,))
-        coloured.putalpha(alpha)
-
-        self.brushImage = coloured
+        colour = tuple(self.penColour[:3])
+        key = (self.brushPath, self.penWidth, self.brushOpacity, colour, "brush")
+        self.brushImage = BRUSH_TIPS.get(key, lambda: prepareTip(self.brushMask, self.penWidth, self.brushOpacity, colour, Image.LANCZOS))
 
     def loadEraserImage(self, path):
         """
@@ -381,103 +1475,82 @@ class Canvas(QGraphicsView):
         if not os.path.exists(path):
             print(f"Eraser brush image not found: {path}")
             return
-        baseImg = Image.open(path).convert("L")
-        mask = mask = baseImg.convert("L")
-        alpha = mask
-        eraserImg = Image.new("RGBA", baseImg.size, (0, 0, 0, 0))
-        eraserImg.putalpha(alpha)
-        self.eraserMask = mask
-        self.eraserImage = eraserImg
+        self.eraserPath = path
+        self.eraserMask = loadTipMask(path)
         self.updateEraser()
 
     def updateEraser(self):
         """
-        Updates the eraaser based off its inputs
+        Updates the eraser based off its inputs
         """
         if self.eraserMask is None:
             return
 
-        scaledSize = (self.eraserWidth, self.eraserWidth)
-        resizedMask = self.eraserMask.resize(scaledSize, Image.LANCZOS)
-
-        # Apply opacity scaling to alpha
-        alpha = resizedMask.point(lambda p: int(p * (self.eraserOpacity / 255)))
-
         # Transparent RGBA with soft alpha
-        eraserImg = Image.new("RGBA", resizedMask.size, (0, 0, 0, 0))
-        eraserImg.putalpha(alpha)
-
-        self.eraserImage = eraserImg
+        key = (self.eraserPath, self.eraserWidth, self.eraserOpacity, None, "eraser")
+        self.eraserImage = BRUSH_TIPS.get(key, lambda: prepareTip(self.eraserMask, self.eraserWidth, self.eraserOpacity, (0, 0, 0), Image.LANCZOS))
 
     def loadPencilImage(self, path):
         if not os.path.exists(path):
             print(f"Pencil brush image not found: {path}")
             return
-        mask = Image.open(path).convert("L")
-        self.pencilMask = mask
+        self.pencilPath = path
+        self.pencilMask = loadTipMask(path)
         self.updatePencil()
 
     def updatePencil(self):
         if self.pencilMask is None:
             return
 
-        size = (self.pencilWidth, self.pencilWidth)
-        resized = self.pencilMask.resize(size, Image.NEAREST)
-        alpha = resized.point(lambda p: int(p * (self.pencilOpacity / 255)))
-        
-        if self.pencilMode == "erase":
-            img = Image.new("RGBA", resized.size, (0, 0, 0, 0))
-            img.putalpha(alpha)
-        else:
-            img = Image.new("RGBA", resized.size, self.penColour[:3] + (0,))
-            img.putalpha(alpha)
-
-        self.pencilImage = img
+        colour = (0, 0, 0) if self.pencilMode == "erase" else tuple(self.penColour[:3])
+        key = (self.pencilPath, self.pencilWidth, self.pencilOpacity, colour, "pencil " + self.pencilMode)
+        self.pencilImage = BRUSH_TIPS.get(key, lambda: prepareTip(self.pencilMask, self.pencilWidth, self.pencilOpacity, colour, Image.NEAREST))
 
     def addLayer(self, layer):
         """
         adds a layer to the canvas
         """
         self.layers.append(layer)
-        item = QGraphicsPixmapItem(layer.qt_pixmap)
-        item.setZValue(len(self.layers))
-        self.customScene.addItem(item)
-        layer.graphicsItem = item
+        layer.canvas = self
+        self.updateLayerOrder(layer.bounds(), layer)
 
         if len(self.layers) == 1:
-            self.centerOn(item)
+            self.centerOn(self.compositeItem)
             self.currentScrollPos = self.mapToScene(self.viewport().rect().center())
 
-    def updateLayerOrder(self):
-        self.customScene.clear()
-
-        if not self.layers:
-            return
-
-        canvasWidth = self.sceneWidth
-        canvasHeight = self.sceneHeight
-
-        # Start with a blank canvas (transparent base)
-        baseImage = Image.new("RGBA", (canvasWidth, canvasHeight), (0, 0, 0, 0))
-
-        for layer in self.layers:
-            # Always use raw image data
-            if layer.pil_image.mode != "RGBA":
-                layer.pil_image = layer.pil_image.convert("RGBA")
-
-            # Blend onto baseImage using blend_modes
-            topLayer = np.array(layer.pil_image).astype(np.float32)
-            baseLayer = np.array(baseImage).astype(np.float32)
-
-            blendFunction = BLEND_MODE_MAP.get(layer.blendMode, normal)
-            blendedLayers = blendFunction(topLayer, baseLayer, layer.opacity / 255.0)
-            blendedLayers = np.clip(blendedLayers, 0, 255).astype(np.uint8)
-            baseImage = Image.fromarray(blendedLayers, mode="RGBA")
+    def layerIndex(self, layer):
+        """
+        Returns the layer's position in the stack, or None if it is not on this canvas.
+        Positions are cached and only rebuilt once the stack has changed under them
+        """
+        index = self.layerPositions.get(layer)
+        if index is None or index >= len(self.layers) or self.layers[index] is not layer:
+            self.releaseAlphaPlanes()
+            self.layerPositions = {stacked: position for position, stacked in enumerate(self.layers)}
+            index = self.layerPositions.get(layer)
+        return index
+
+    def releaseAlphaPlanes(self):
+        """
+        Drops the cached alpha planes of layers that no longer have a clipped layer directly above them
+        """
+        bases = {self.layers[index - 1] for index in range(1, len(self.layers)) if self.layers[index].clippingMaskEnabled}
+        for layer in set(self.layerPositions).union(self.layers):
+            if layer not in bases:
+                layer.alphaCache = None
 
-            # Update visual layer from composite
-            layer.qt_pixmap = QPixmap.fromImage(ImageQt.ImageQt(baseImage))
-            layer.graphicsItem = QGraphicsPixmapItem(layer.qt_pixmap)
-            self.customScene.addItem(layer.graphicsItem)
+    def updateLayerOrder(self, rect=None, layer=None):
+        """
+        Recomposites the layer stack and repaints only the tiles that changed.
+        With no arguments, only the effects of layers being added, removed or reordered are redone.
+        Otherwise the rectangle (the whole canvas if None) is redone from the given layer upwards,
+        reusing the cached composite below it
+        """
+        if rect is not None or layer is not None:
+            fromIndex = self.layerIndex(layer) or 0
+            self.compositor.markDirty(rect, fromIndex)
+        for x0, y0, x1, y1 in self.compositor.composite(self.layers):
+            self.compositeItem.update(QRectF(x0, y0, x1 - x0, y1 - y0))
 
     def wheelEvent(self, event):
         """
@@ -516,8 +1589,16 @@ class Canvas(QGraphicsView):
             self.pushUndo("Fill tool")
             scenePos = self.mapToScene(event.position().toPoint())
             x, y = int(scenePos.x()), int(scenePos.y())
-            self.floodFill(x, y, self.penColour)
-            self.currentLayer.updatePixmap()
+            perceptual = self.fillDistance == "perceptual"
+            if self.fillMode == "contiguous":
+                filled = self.floodFill(x, y, self.penColour, self.fillTolerance, perceptual)
+            elif 0 <= x < self.sceneWidth and 0 <= y < self.sceneHeight:
+                targetColour = self.currentLayer.pixels[y, x]
+                filled = self.replaceColour(targetColour, self.penColour, self.fillTolerance, perceptual, keepAlpha=self.fillMode == "replace")
+            else:
+                filled = None
+            if filled:
+                self.currentLayer.updatePixmap(filled)
             event.accept()
             return
         
@@ -525,7 +1606,8 @@ class Canvas(QGraphicsView):
             self.pushUndo("Shape Tool")
             scenePos = self.mapToScene(event.position().toPoint())
             self.shapeStartPoint = (int(scenePos.x()), int(scenePos.y()))
-            self.shapePreviewBuffer = self.currentLayer.pil_image.copy()
+            self.shapePreviewBuffer = self.currentLayer.snapshot()
+            self.shapeRect = None
             event.accept()
             return
         
@@ -560,10 +1642,24 @@ class Canvas(QGraphicsView):
 
             elif self.selectionTool == "lasso":
                 self.lassoPoints = [pos]
+                self.lassoDrawn = 1
+                self.lassoCone = None
 
                 if self.lassoPathItem:
                     self.customScene.removeItem(self.lassoPathItem)
-                    self.lassoPathItem = None
+
+                # One path item for the whole lasso, extended as the pointer moves
+                path = QPainterPath()
+                path.moveTo(pos)
+                self.lassoPathItem = QGraphicsPathItem(path)
+                pen = QPen(QColor(0, 120, 215), 1, Qt.PenStyle.DashLine)
+                pen.setCosmetic(True)
+                self.lassoPathItem.setPen(pen)
+                self.lassoPathItem.setZValue(1000)
+                self.customScene.addItem(self.lassoPathItem)
+
+            elif self.selectionTool == "wand":
+                self.magicWandSelect(math.floor(pos.x()), math.floor(pos.y()))
 
             return
         scenePos = self.mapToScene(event.position().toPoint())
@@ -577,18 +1673,23 @@ class Canvas(QGraphicsView):
 
             if clickedHandle is not None:
                 print(f"[PRESS] Transform handle {clickedHandle} clicked")
+                box = self.selectionBounds() if self.selectionMask else self.currentLayer.bounds()
+                if not box or box[0] >= box[2] or box[1] >= box[3]:
+                    return
+                self.pushUndo("Rotate" if clickedHandle == 8 else "Scale")
                 self.currentHandle = clickedHandle
-                self.transformOriginal = self.currentLayer.pil_image.copy()
-                self.transformBoundingBox = self.selectionMask.getbbox() if self.selectionMask else self.currentLayer.pil_image.getbbox()
+                self.transformBoundingBox = box
                 self.dragStartPosition = scenePos
                 self.transformationMode = "selection" if self.selectionMask else "layer"
+                self.handleOrigins = [handle.pos() for handle in self.transformationHandles]
 
                 if clickedHandle == 8:
-                    cx = (self.transformBoundingBox[0] + self.transformBoundingBox[2]) / 2
-                    cy = (self.transformBoundingBox[1] + self.transformBoundingBox[3]) / 2
+                    cx = (box[0] + box[2]) / 2
+                    cy = (box[1] + box[3]) / 2
                     self.pointOfRotation = QPointF(cx, cy)
                     self.rotationStartAngle = math.atan2(scenePos.y() - cy, scenePos.x() - cx)
-                    self.rotationBackup = self.currentLayer.pil_image.copy()
+                # The drag only moves a preview of the lifted pixels, they are resampled once on release
+                self.liftSelection()
                 return
 
             # No handle clicked — check for translation
@@ -596,9 +1697,10 @@ class Canvas(QGraphicsView):
                 try:
                     if self.selectionMask.getpixel((int(scenePos.x()), int(scenePos.y()))) > 0:
                         print("[PRESS] Inside selection — start translation")
+                        self.pushUndo("Move Selection")
                         self.selectionStartPoint = (int(scenePos.x()), int(scenePos.y()))
                         self.isSelectionMoving = True
-                        self.selectionMovedBackup = self.currentLayer.pil_image.copy()
+                        self.liftSelection()
                         return
                 except Exception as e:
                     print("[PRESS] Selection check error:", e)
@@ -630,11 +1732,11 @@ class Canvas(QGraphicsView):
                 spacing = self.brushSpacing if self.currentTool == 'paintbrush' else self.eraserSpacing
                 if distance >= spacing:
                     steps = int(distance / spacing)
+                    points = []
                     for i in range(steps):
                         t = i / steps
-                        ix = int(self.lastStampPos[0] + dx * t)
-                        iy = int(self.lastStampPos[1] + dy * t)
-                        self.stampBrush(ix, iy)
+                        points.append((int(self.lastStampPos[0] + dx * t), int(self.lastStampPos[1] + dy * t)))
+                    self.stampDabs(points)
                     self.lastStampPos = current
             event.accept()
             return
@@ -642,13 +1744,24 @@ class Canvas(QGraphicsView):
         if self.currentTool == "shape" and self.shapeStartPoint and self.currentLayer:
             scenePos = self.mapToScene(event.position().toPoint())
             endPoint = (int(scenePos.x()), int(scenePos.y()))
-            self.currentLayer.pil_image = self.shapePreviewBuffer.copy()
-
-            draw = ImageDraw.Draw(self.currentLayer.pil_image, "RGBA")
             shape = self.getShapeType()
             width = self.getShapeWidth()
             colour = self.penColour
 
+            # Only the last preview's area is put back, then the new shape's area is drawn over
+            layer = self.currentLayer
+            (sx, sy), (ex, ey) = self.shapeStartPoint, endPoint
+            shapeRect = (min(sx, ex) - width, min(sy, ey) - width, max(sx, ex) + width + 1, max(sy, ey) + width + 1)
+            damaged = unionRect(self.shapeRect, shapeRect)
+            layer.prepareWrite(damaged)
+            if self.shapeRect:
+                x0, y0 = max(0, self.shapeRect[0]), max(0, self.shapeRect[1])
+                restored = self.shapePreviewBuffer.region(self.shapeRect)
+                layer.pixels[y0:y0 + restored.shape[0], x0:x0 + restored.shape[1]] = restored
+            self.shapeRect = shapeRect
+
+            draw = ImageDraw.Draw(layer.pil_image, "RGBA")
+
             if shape == "Line":
                 draw.line([self.shapeStartPoint, endPoint], fill=colour, width=width)
             elif shape == "Rectangle":
@@ -658,7 +1771,7 @@ class Canvas(QGraphicsView):
                 rect = self.normaliseRect(self.shapeStartPoint, endPoint)
                 draw.ellipse(rect, outline=colour, width=width)
 
-            self.currentLayer.updatePixmap()
+            layer.updatePixmap(damaged)
             event.accept()
             return
         if self.currentTool == "selection" and self.isSelectionDragging:
@@ -679,23 +1792,8 @@ class Canvas(QGraphicsView):
                 self.selectionItem.setZValue(1000)
                 self.customScene.addItem(self.selectionItem)
 
-            elif self.selectionTool == "lasso":
-                self.lassoPoints.append(pos)
-
-                if self.lassoPathItem:
-                    self.customScene.removeItem(self.lassoPathItem)
-
-                path = QPainterPath()
-                path.moveTo(self.lassoPoints[0])
-                for pt in self.lassoPoints[1:]:
-                    path.lineTo(pt)
-
-                self.lassoPathItem = QGraphicsPathItem(path)
-                pen = QPen(QColor(0, 120, 215), 1, Qt.PenStyle.DashLine)
-                pen.setCosmetic(True)
-                self.lassoPathItem.setPen(pen)
-                self.lassoPathItem.setZValue(1000)
-                self.customScene.addItem(self.lassoPathItem)
+            elif self.selectionTool == "lasso" and self.lassoPoints:
+                self.addLassoPoint(pos)
 
             return
             
@@ -707,104 +1805,22 @@ class Canvas(QGraphicsView):
                 dy = int(scenePos.y()) - self.selectionStartPoint[1]
                 print(f"[MOVE] Translating selection by ({dx}, {dy})")
 
-                source = self.selectionMovedBackup
-                mask = self.selectionMask
-                self.currentLayer.pil_image = source.copy()
-
-                region = Image.composite(source, Image.new("RGBA", source.size, (0, 0, 0, 0)), mask)
-                cleared = Image.composite(Image.new("RGBA", source.size, (0, 0, 0, 0)), source, mask)
-                self.currentLayer.pil_image = cleared
-                self.currentLayer.pil_image.paste(region, (dx, dy), region)
-
-                newMask = Image.new("L", mask.size, 0)
-                newMask.paste(mask, (dx, dy))
+                # Only the floating item moves during the drag, the layer is written once on release
                 self.selectionDragOffset = (dx, dy)
-                self.selectionMovedMask = newMask
+                if self.floatingItem:
+                    self.floatingItem.setPos(dx, dy)
 
                 if self.selectionItem:
                     self.selectionItem.setPos(dx, dy)
-
-                self.currentLayer.updatePixmap()
-                self.viewport().update()
                 return
             
-            if self.currentHandle == 8 and self.pointOfRotation and self.rotationBackup:
-                print("[MOVE] Rotating selection/layer")
-
-                pos = self.mapToScene(event.position().toPoint())
-                centreX, centreY = self.pointOfRotation.x(), self.pointOfRotation.y()
-
-                currentAngle = math.atan2(pos.y() - centreY, pos.x() - centreX)
-                angleDelta = math.degrees(currentAngle - self.rotationStartAngle)
-
-                source = self.rotationBackup
-                x0, y0, x1, y1 = self.transformBoundingBox
-                region = source.crop((x0, y0, x1, y1))
-
-                if self.transformationMode == "selection" and self.selectionMask:
-                    mask = self.selectionMask
-                    maskCrop = mask.crop((x0, y0, x1, y1))
-
-                    cleared = Image.composite(Image.new("RGBA", source.size, (0, 0, 0, 0)), source, mask)
-
-                    rotatedRegion = region.rotate(-angleDelta, resample=Image.NEAREST, center=(region.width // 2, region.height // 2), expand=True)
-                    rotatedMask = maskCrop.rotate(-angleDelta, resample=Image.Resampling.NEAREST, center=(maskCrop.width // 2, maskCrop.height // 2), expand=True)
-
-                    newWidth, newHeight = rotatedRegion.size
-                    pasteX = int(centreX - newWidth // 2)
-                    pasteY = int(centreY - newHeight // 2)
-
-                    result = cleared.copy()
-                    result.paste(rotatedRegion, (pasteX, pasteY), rotatedMask)
-                    self.currentLayer.pil_image = result
-
-                    # Store for release
-                    self.rotatedMaskPreview = Image.new("L", mask.size, 0)
-                    self.rotatedMaskPreview.paste(rotatedMask, (pasteX, pasteY))
-                    self.rotatedPreview = result
-
-                    # Rotate selectionItem visually
-                    if self.selectionItem:
-                        transform = QTransform()
-                        transform.translate(centreX, centreY)
-                        transform.rotate(angleDelta)
-                        transform.translate(-centreX, -centreY)
-                        self.selectionItem.setTransform(transform)
-
-                    # Update handles
-                    if self.transformationHandles:
-                        handles = [
-                            QPointF(x0, y0),  # 0 top-left
-                            QPointF(x1, y0),  # 1 top-right
-                            QPointF(x1, y1),  # 2 bottom-right
-                            QPointF(x0, y1),  # 3 bottom-left
-                            QPointF((x0 + x1) / 2, y0),         # 4 top-center
-                            QPointF(x1, (y0 + y1) / 2),         # 5 right-center
-                            QPointF((x0 + x1) / 2, y1),         # 6 bottom-center
-                            QPointF(x0, (y0 + y1) / 2),         # 7 left-center
-                            QPointF((x0 + x1) / 2, y0 - 30),    # 8 rotation handle
-                        ]
-
-                        # Apply rotation to each point
-                        for i, handle in enumerate(self.transformationHandles):
-                            pt = handles[i]
-                            vec = pt - self.pointOfRotation
-                            radians = math.radians(angleDelta)
-                            rotated = QPointF(
-                                vec.x() * math.cos(radians) - vec.y() * math.sin(radians),
-                                vec.x() * math.sin(radians) + vec.y() * math.cos(radians)
-                            ) + self.pointOfRotation
-                            handle.setPos(rotated)
-
-                else:
-                    # Rotate full image (no selection)
-                    rotated = source.rotate(-angleDelta, center=(centreX, centreY), resample=Image.BICUBIC)
-                    self.currentLayer.pil_image = rotated
-                    self.rotatedPreview = rotated
-                    self.rotatedMaskPreview = None
-
-                self.currentLayer.updatePixmap()
-                self.viewport().update()
+            if self.currentHandle is not None and self.floatingItem:
+                transform = self.handleTransform(scenePos)
+                self.floatingItem.setTransform(self.floatingBase() * transform)
+                if self.selectionItem:
+                    self.selectionItem.setTransform(transform)
+                for handle, origin in zip(self.transformationHandles, self.handleOrigins):
+                    handle.setPos(transform.map(origin))
                 return
         super().mouseMoveEvent(event)
 
@@ -820,8 +1836,7 @@ class Canvas(QGraphicsView):
 
         if self.currentTool in ("paintbrush", "eraser", "pencil") and self.drawing and event.button() == Qt.MouseButton.LeftButton:
             self.drawing = False
-            if self.currentLayer:
-                self.currentLayer.updatePixmap()
+            self.endStroke()
             self.lastPoint = None
             self.lastStampPos = None
             event.accept()
@@ -829,7 +1844,7 @@ class Canvas(QGraphicsView):
         if self.currentTool == "shape" and event.button() == Qt.MouseButton.LeftButton and self.shapeStartPoint:
             self.shapeStartPoint = None
             self.shapePreviewBuffer = None
-            self.currentLayer.updatePixmap()
+            self.shapeRect = None
             event.accept()
             return
 
@@ -842,135 +1857,32 @@ class Canvas(QGraphicsView):
                 self.selectionStartPoint = None
 
             elif self.selectionTool == "lasso":
+                self.lassoTimer.stop()
                 if len(self.lassoPoints) > 2:
                     self.finaliseLassoSelection(modifiers)
 
             return
         if self.currentTool == "transform":
             if self.currentHandle is not None:
-                print("[RELEASE] Committing transform scale")
+                print("[RELEASE] Committing transform")
 
                 end = self.mapToScene(event.position().toPoint())
-                start = self.dragStartPosition
-                dx = end.x() - start.x()
-                dy = end.y() - start.y()
-
-                x0, y0, x1, y1 = self.transformBoundingBox
-                width = x1 - x0
-                height = y1 - y0
-
-                sx = sy = 1.0
-                origin_x, origin_y = x0, y0
-                h = self.currentHandle
-
-                # Multi-directional transform logic
-                if h == 0:  # Top-Left
-                    sx = (width - dx) / width
-                    sy = (height - dy) / height
-                    origin_x, origin_y = x1, y1
-                elif h == 1:  # Top-Right
-                    sx = (width + dx) / width
-                    sy = (height - dy) / height
-                    origin_x, origin_y = x0, y1
-                elif h == 2:  # Bottom-Right
-                    sx = (width + dx) / width
-                    sy = (height + dy) / height
-                elif h == 3:  # Bottom-Left
-                    sx = (width - dx) / width
-                    sy = (height + dy) / height
-                    origin_x, origin_y = x1, y0
-                elif h == 4:  # Top-Center
-                    sx = 1.0
-                    sy = (height - dy) / height
-                    origin_x, origin_y = x0, y1
-                elif h == 5:  # Right-Center
-                    sx = (width + dx) / width
-                    sy = 1.0
-                elif h == 6:  # Bottom-Center
-                    sx = 1.0
-                    sy = (height + dy) / height
-                elif h == 7:  # Left-Center
-                    sx = (width - dx) / width
-                    sy = 1.0
-                    origin_x, origin_y = x1, y0
-                if self.currentHandle == 8:
-                    print("[RELEASE] Commit rotation")
-
-                    if self.rotatedPreview:
-                        self.currentLayer.pil_image = self.rotatedPreview
-
-                        if self.rotatedMaskPreview:
-                            self.selectionMask = self.rotatedMaskPreview
-
-                            if self.selectionItem:
-                                self.customScene.removeItem(self.selectionItem)
-                                self.selectionItem = None
-                            self.drawSelectionOutline()
-
-                    self.currentLayer.updatePixmap()
-                    self.showTransformHandles()
-                    self.pushUndo("Rotate")
-                    if self.selectionItem:
-                        self.selectionItem.setTransform(QTransform())
-                    for handle in self.transformationHandles:
-                        handle.setTransform(QTransform())
-
-                    self.currentHandle = None
-                    self.rotationBackup = None
-                    self.pointOfRotation = None
-                    self.rotationStartAngle = None
-                    self.rotatedPreview = None
-                    self.rotatedMaskPreview = None
-                    return
-
-                sx = max(0.01, sx)
-                sy = max(0.01, sy)
-
-                img = self.transformOriginal
-                region = img.crop((x0, y0, x1, y1))
-                origin = (int(origin_x), int(origin_y))
-
-                if self.transformationMode == "selection" and self.selectionMask:
-                    maskCrop = self.selectionMask.crop((x0, y0, x1, y1))
-                    region_cut = Image.composite(region, Image.new("RGBA", region.size, (0, 0, 0, 0)), maskCrop)
-
-                    new_size = (int(region.width * sx), int(region.height * sy))
-                    scaled_region = region_cut.resize(new_size, Image.LANCZOS)
-                    scaled_mask = maskCrop.resize(new_size, resample=Image.Resampling.NEAREST)
-
-                    result = img.copy()
-                    result.paste(Image.new("RGBA", region.size, (0, 0, 0, 0)), (x0, y0))
-                    result.paste(scaled_region, origin, scaled_mask)
-
-                    self.currentLayer.pil_image = result
-
-                    newMask = Image.new("L", self.selectionMask.size, 0)
-                    newMask.paste(scaled_mask, origin)
-                    self.selectionMask = newMask
-
-                    if self.selectionItem:
-                        self.customScene.removeItem(self.selectionItem)
-                        self.selectionItem = None
+                if self.selectionItem:
+                    self.selectionItem.setTransform(QTransform())
+                mask = self.selectionMask
+                self.dropSelection(self.handleTransform(end))
+                if self.selectionMask is mask:
+                    # The mask didn't change, so pick up any outline traced during the drag
                     self.drawSelectionOutline()
-
-                else:
-                    new_size = (int(region.width * sx), int(region.height * sy))
-                    scaled = region.resize(new_size, resample=Image.LANCZOS)
-
-                    result = img.copy()
-                    result.paste(Image.new("RGBA", region.size, (0, 0, 0, 0)), (x0, y0))
-                    result.paste(scaled, origin, scaled)
-                    self.currentLayer.pil_image = result
-
-                self.currentLayer.updatePixmap()
                 self.showTransformHandles()
-                self.pushUndo("Scale")
 
                 # Reset state
                 self.currentHandle = None
-                self.transformOriginal = None
                 self.transformBoundingBox = None
                 self.dragStartPosition = None
+                self.pointOfRotation = None
+                self.rotationStartAngle = None
+                self.handleOrigins = []
                 return
 
             # Restore: translation release logic
@@ -979,322 +1891,260 @@ class Canvas(QGraphicsView):
 
                 self.isSelectionMoving = False
                 self.selectionStartPoint = None
-                self.selectionMovedBackup = None
-
-                if self.selectionMovedMask:
-                    self.selectionMask = self.selectionMovedMask
-                    self.selectionMovedMask = None
-
-                    if self.selectionItem:
-                        self.customScene.removeItem(self.selectionItem)
-                        self.selectionItem = None
-                    self.drawSelectionOutline()
-
-                self.currentLayer.updatePixmap()
-                self.showTransformHandles()
-                self.pushUndo("Move Selection")
-                return
-
-            if self.currentHandle is not None:
-                print("[RELEASE] Committing transform scale")
-
-                end = self.mapToScene(event.position().toPoint())
-                x0, y0, x1, y1 = self.transformBoundingBox
-                width, height = x1 - x0, y1 - y0
-                sx = sy = 1.0
-                origin = (x0, y0)
-
-                if self.currentHandle == 0:  # top-left
-                    sx = (x1 - end.x()) / width
-                    sy = (y1 - end.y()) / height
-                    origin = (x1, y1)
-                elif self.currentHandle == 2:  # bottom-right
-                    sx = (end.x() - x0) / width
-                    sy = (end.y() - y0) / height
-                    origin = (x0, y0)
-
-                img = self.transformOriginal
-                region = img.crop((x0, y0, x1, y1))
-
-                if self.transformationMode == "selection" and self.selectionMask:
-                    maskCrop = self.selectionMask.crop((x0, y0, x1, y1))
-                    region_cut = Image.composite(region, Image.new("RGBA", region.size, (0, 0, 0, 0)), maskCrop)
-
-                    new_size = (max(1, int(region.width * sx)), max(1, int(region.height * sy)))
-                    scaled_region = region_cut.resize(new_size, Image.LANCZOS)
-                    scaled_mask = maskCrop.resize(new_size, resample=Image.Resampling.NEAREST)
-
-                    result = img.copy()
-                    result.paste(Image.new("RGBA", region.size, (0, 0, 0, 0)), (x0, y0))
-                    result.paste(scaled_region, (int(origin[0]), int(origin[1])), scaled_mask)
-
-                    self.currentLayer.pil_image = result
-
-                    # Update selection mask
-                    newMask = Image.new("L", self.selectionMask.size, 0)
-                    newMask.paste(scaled_mask, (int(origin[0]), int(origin[1])))
-                    self.selectionMask = newMask
-
-                    # Update marching ants
-                    if self.selectionItem:
-                        self.customScene.removeItem(self.selectionItem)
-                        self.selectionItem = None
+                if self.selectionItem:
+                    self.selectionItem.setPos(0, 0)
+                mask = self.selectionMask
+                self.dropSelection()
+                if self.selectionMask is mask:
                     self.drawSelectionOutline()
-
-                else:  # transform full layer
-                    new_size = (max(1, int(region.width * sx)), max(1, int(region.height * sy)))
-                    scaled = region.resize(new_size, resample=Image.LANCZOS)
-
-                    result = img.copy()
-                    result.paste(Image.new("RGBA", region.size, (0, 0, 0, 0)), (x0, y0))
-                    result.paste(scaled, (int(origin[0]), int(origin[1])), scaled)
-
-                    self.currentLayer.pil_image = result
-
-                self.currentLayer.updatePixmap()
                 self.showTransformHandles()
-                self.pushUndo("Scale")
-
-                # Reset state
-                self.currentHandle = None
-                self.transformOriginal = None
-                self.transformBoundingBox = None
-                self.dragStartPosition = None
                 return
 
-            if self.isSelectionMoving:
-                print("[RELEASE] Commit selection move")
-
-                self.isSelectionMoving = False
-                self.selectionStartPoint = None
-                self.selectionMovedBackup = None
-
-                if self.selectionMovedMask:
-                    self.selectionMask = self.selectionMovedMask
-                    self.selectionMovedMask = None
+        super().mouseReleaseEvent(event)
 
-                    # Update marching ants
-                    if self.selectionItem:
-                        self.customScene.removeItem(self.selectionItem)
-                        self.selectionItem = None
-                    self.drawSelectionOutline()
+    def frameInterval(self):
+        """
+        Returns the time between monitor refreshes in milliseconds
+        """
+        screen = self.screen()
+        refreshRate = screen.refreshRate() if screen else 0
+        if refreshRate <= 0:
+            refreshRate = 60
+        return max(1, int(1000 / refreshRate))
 
-                self.currentLayer.updatePixmap()
-                self.showTransformHandles()
-                self.pushUndo("Move Selection")
-                return
+    def queueDisplayUpdate(self, rect):
+        """
+        Records a dab's rectangle and schedules a redraw for the next monitor refresh
+        """
+        self.pendingDamage = unionRect(self.pendingDamage, rect)
+        if not self.displayTimer.isActive():
+            self.displayTimer.start(self.frameInterval())
 
-        super().mouseReleaseEvent(event)
+    def flushDisplayUpdate(self):
+        """
+        Recomposites and redraws only the area touched since the last refresh
+        """
+        self.displayTimer.stop()
+        rect = self.pendingDamage
+        self.pendingDamage = None
+        if rect and self.currentLayer:
+            self.currentLayer.updatePixmap(rect)
 
     def stampBrush(self, x, y):
         """
-        Brush/eraser/pencil stamping logic, with support for selection and clipping masks.
+        Stamps a single dab of the current tool at (x, y)
         """
-        if not self.currentLayer:
+        self.stampDabs([(x, y)])
+
+    def stampDabs(self, points):
+        """
+        Brush/eraser/pencil stroke engine, with support for selection and clipping masks.
+        Rasterizes every dab of a stroke segment in one go over the segment's bounding box,
+        into the stroke buffer that gets merged into the layer when the stroke ends
+        """
+        if not self.currentLayer or not points:
             return
 
         if self.currentTool == "eraser" and self.eraserImage:
-            bx, by = self.eraserImage.size
-            px = x - bx // 2
-            py = y - by // 2
-
-            base = self.currentLayer.pil_image.crop((px, py, px + bx, py + by)).copy()
-            eraserAlpha = self.eraserImage.getchannel("A")
-
-            # Clipping + selection mask
-            combinedMask = eraserAlpha
-
-            if self.selectionMask:
-                selectionCrop = self.selectionMask.crop((px, py, px + bx, py + by))
-                combinedMask = ImageChops.multiply(combinedMask, selectionCrop)
-
-            if self.currentLayer.clippingMaskEnabled:
-                eraserIndex = self.layers.index(self.currentLayer)
-                if eraserIndex > 0:
-                    below = self.layers[eraserIndex - 1]
-                    belowCrop = below.pil_image.crop((px, py, px + bx, py + by))
-                    belowAlpha = belowCrop.getchannel("A")
-                    combinedMask = ImageChops.multiply(combinedMask, belowAlpha)
-                else:
-                    return  # No layer below to clip to
-
-            # Subtract from alpha channel
-            r, g, b, a = base.split()
-            a = ImageChops.subtract(a, combinedMask)
-            base = Image.merge("RGBA", (r, g, b, a))
-
-            self.currentLayer.pil_image.paste(base, (px, py))
-
+            tip, erasing = self.eraserImage, True
         elif self.currentTool == "paintbrush" and self.brushImage:
-            bx, by = self.brushImage.size
-            px = x - bx // 2
-            py = y - by // 2
-
-            region = self.currentLayer.pil_image.crop((px, py, px + bx, py + by))
-            blended = Image.alpha_composite(region, self.brushImage)
-
-            # Build combined mask (selection + clipping)
-            brushAlpha = self.brushImage.split()[-1]
-            combinedMask = brushAlpha
-
-            if self.selectionMask:
-                selectionCrop = self.selectionMask.crop((px, py, px + bx, py + by))
-                combinedMask = ImageChops.multiply(combinedMask, selectionCrop)
-
-            if self.currentLayer.clippingMaskEnabled:
-                brushIndex = self.layers.index(self.currentLayer)
-                if brushIndex > 0:
-                    below = self.layers[brushIndex - 1]
-                    belowCrop = below.pil_image.crop((px, py, px + bx, py + by))
-                    belowAlpha = belowCrop.getchannel("A")
-                    combinedMask = ImageChops.multiply(combinedMask, belowAlpha)
-                else:
-                    return  # Nothing to clip to
-
-            self.currentLayer.pil_image.paste(blended, (px, py), combinedMask)
-
+            tip, erasing = self.brushImage, False
         elif self.currentTool == "pencil" and self.pencilImage:
-            bx, by = self.pencilImage.size
-            px = x - bx // 2
-            py = y - by // 2
-
-            if bx == 1 and by == 1 and self.pencilMode == "draw":
-                if 0 <= px < self.currentLayer.pil_image.width and 0 <= py < self.currentLayer.pil_image.height:
-                    allowDraw = True
-
-                    if self.selectionMask and self.selectionMask.getpixel((px, py)) == 0:
-                        allowDraw = False
-
-                    if self.currentLayer.clippingMaskEnabled:
-                        pencilIndex = self.layers.index(self.currentLayer)
-                        if pencilIndex > 0:
-                            below = self.layers[pencilIndex - 1]
-                            belowAlpha = below.pil_image.getchannel("A")
-                            if belowAlpha.getpixel((px, py)) == 0:
-                                allowDraw = False
-                        else:
-                            return  # No layer to clip to
-
-                    if allowDraw:
-                        self.currentLayer.pil_image.putpixel((px, py), self.penColour)
-                return
-
-            # Pencil draw/erase with brush
-            if self.pencilMode == "erase":
-                base = self.currentLayer.pil_image.crop((px, py, px + bx, py + by)).copy()
-                eraserAlpha = self.pencilImage.getchannel("A")
-                combinedMask = eraserAlpha
-
-                if self.selectionMask:
-                    selectionCrop = self.selectionMask.crop((px, py, px + bx, py + by))
-                    combinedMask = ImageChops.multiply(combinedMask, selectionCrop)
-
-                if self.currentLayer.clippingMaskEnabled:
-                    idx = self.layers.index(self.currentLayer)
-                    if idx > 0:
-                        below = self.layers[idx - 1]
-                        belowCrop = below.pil_image.crop((px, py, px + bx, py + by))
-                        belowAlpha = belowCrop.getchannel("A")
-                        combinedMask = ImageChops.multiply(combinedMask, belowAlpha)
-                    else:
-                        return
+            tip, erasing = self.pencilImage, self.pencilMode == "erase"
+        else:
+            return
 
-                r, g, b, a = base.split()
-                a = ImageChops.subtract(a, combinedMask)
-                base = Image.merge("RGBA", (r, g, b, a))
-                self.currentLayer.pil_image.paste(base, (px, py))
+        below = None
+        if self.currentLayer.clippingMaskEnabled:
+            layerIndex = self.layerIndex(self.currentLayer)
+            if layerIndex == 0:
+                return  # No layer below to clip to
+            below = self.layers[layerIndex - 1]
+
+        height, width = self.currentLayer.pixels.shape[:2]
+        bx, by = tip.size
+        xs = np.array([p[0] for p in points]) - bx // 2
+        ys = np.array([p[1] for p in points]) - by // 2
+
+        # Segment bounding box, clipped to the layer
+        x0, y0 = max(0, int(xs.min())), max(0, int(ys.min()))
+        x1, y1 = min(width, int(xs.max()) + bx), min(height, int(ys.max()) + by)
+        if x0 >= x1 or y0 >= y1:
+            return
 
-            else:
-                region = self.currentLayer.pil_image.crop((px, py, px + bx, py + by))
-                blended = Image.alpha_composite(region, self.pencilImage)
-
-                pencilAlpha = self.pencilImage.split()[-1]
-                combinedMask = pencilAlpha
-
-                if self.selectionMask:
-                    selectionCrop = self.selectionMask.crop((px, py, px + bx, py + by))
-                    combinedMask = ImageChops.multiply(combinedMask, selectionCrop)
-
-                if self.currentLayer.clippingMaskEnabled:
-                    idx = self.layers.index(self.currentLayer)
-                    if idx > 0:
-                        below = self.layers[idx - 1]
-                        belowCrop = below.pil_image.crop((px, py, px + bx, py + by))
-                        belowAlpha = belowCrop.getchannel("A")
-                        combinedMask = ImageChops.multiply(combinedMask, belowAlpha)
-                    else:
-                        return
+        # Selection and clipping limits shared by every dab in the segment
+        limit = None
+        if self.selectionMask:
+            selected = self.selectionMask.getbbox()
+            if selected is None or x1 <= selected[0] or selected[2] <= x0 or y1 <= selected[1] or selected[3] <= y0:
+                return  # The whole segment is outside the selection
+            limit = self.selectionMask.region((x0, y0, x1, y1)).astype(np.float32) / 255.0
+        if below is not None:
+            belowAlpha = below.alphaPlane()[y0:y1, x0:x1].astype(np.float32) / 255.0
+            limit = belowAlpha if limit is None else limit * belowAlpha
+
+        stroke = self.strokeBuffer
+        if stroke is None or stroke.layer is not self.currentLayer:
+            stroke = self.strokeBuffer = StrokeBuffer(self.currentLayer, tip.getpixel((0, 0)), erasing)
+        stroke.reserve((x0, y0, x1, y1))
+
+        segment = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        if bx == 1 and by == 1 and self.currentTool == "pencil" and not erasing:
+            # Single pixel pencil lays down the pen colour at full strength
+            inside = (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)
+            segment[ys[inside] - y0, xs[inside] - x0] = self.penColour[3]
+        else:
+            tipAlpha = np.asarray(tip.getchannel("A"))
+            for px, py in zip(xs.tolist(), ys.tolist()):
+                dx0, dy0 = max(px, x0), max(py, y0)
+                dx1, dy1 = min(px + bx, x1), min(py + by, y1)
+                if dx0 >= dx1 or dy0 >= dy1:
+                    continue
+                target = segment[dy0 - y0:dy1 - y0, dx0 - x0:dx1 - x0]
+                np.maximum(target, tipAlpha[dy0 - py:dy1 - py, dx0 - px:dx1 - px], out=target)
 
-                self.currentLayer.pil_image.paste(blended, (px, py), combinedMask)
+        if limit is not None:
+            segment = (segment * limit + 0.5).astype(np.uint8)
+        coverage = stroke.region(x0, y0, x1, y1)
+        np.maximum(coverage, segment, out=coverage)
 
+        self.queueDisplayUpdate((x0, y0, x1, y1))
 
+    def endStroke(self):
+        """
+        Shows any last dabs, then merges the finished stroke into its layer.
+        The screen already shows the merged result, so nothing needs recompositing
+        """
+        self.flushDisplayUpdate()
+        stroke = self.strokeBuffer
+        self.strokeBuffer = None
+        if stroke is not None:
+            stroke.merge()
 
 
-    def floodFill(self, x, y, fillColour, tolerance=0):
+    def colourMatchMask(self, pixels, targetColour, tolerance=0, perceptual=False, matchAlpha=False):
         """
-        Fills all neighboring pixels within a given colour tolerance and selection mask.
+        Returns a 0/255 mask of the pixels matching the colour.
+        RGB matching allows the tolerance on every channel, perceptual matching allows it as a CIELAB distance
         """
-        img = self.currentLayer.pil_image
-        pixels = img.load()
-        width, height = img.size
-
-        if not (0 <= x < width and 0 <= y < height):
-            return
+        targetColour = tuple(int(value) for value in targetColour)
+        alphaLow, alphaHigh = 0, 255
+        if matchAlpha:
+            alphaLow, alphaHigh = max(0, targetColour[3] - tolerance), min(255, targetColour[3] + tolerance)
+
+        if not perceptual:
+            lower = np.array([max(0, value - tolerance) for value in targetColour[:3]] + [alphaLow], dtype=np.uint8)
+            upper = np.array([min(255, value + tolerance) for value in targetColour[:3]] + [alphaHigh], dtype=np.uint8)
+            return cv2.inRange(pixels, lower, upper)
+
+        # OpenCV stores 8 bit L as 0-255, so scale it back to 0-100 before measuring the distance
+        lab = cv2.cvtColor(cv2.cvtColor(pixels, cv2.COLOR_RGBA2RGB), cv2.COLOR_RGB2Lab)
+        targetLab = cv2.cvtColor(np.array([[targetColour[:3]]], dtype=np.uint8), cv2.COLOR_RGB2Lab)[0, 0]
+        difference = cv2.absdiff(lab, tuple(float(value) for value in targetLab)).astype(np.float32)
+        squared = cv2.multiply(difference, difference)
+        distance = cv2.transform(squared, np.array([[(100 / 255) ** 2, 1, 1]], dtype=np.float32))
+        matching = cv2.compare(distance, float(tolerance * tolerance), cv2.CMP_LE)
+        if matchAlpha:
+            alpha = pixels[..., 3]
+            matching[(alpha < alphaLow) | (alpha > alphaHigh)] = 0
+        return matching
+
+    def editableBox(self):
+        """
+        Returns the part of the current layer edits can reach, the selection's bounding box or the whole layer.
+        None if the selection is empty
+        """
+        if self.selectionMask:
+            return self.selectionMask.getbbox()
+        height, width = self.currentLayer.pixels.shape[:2]
+        return (0, 0, width, height)
 
-        # Check selection mask first
+    def limitToEditable(self, mask, origin=(0, 0)):
+        """
+        Clears the parts of a 0/255 mask placed at origin outside the selection, or outside the layer below when clipping
+        """
         if self.selectionMask:
-            if self.selectionMask.getpixel((x, y)) == 0:
-                return  # Start point is not selected
+            self.selectionMask.clearOutside(mask, origin)
         if self.currentLayer.clippingMaskEnabled:
-            idx = self.layers.index(self.currentLayer)
+            idx = self.layerIndex(self.currentLayer)
             if idx > 0:
-                below = self.layers[idx - 1]
-                belowAlpha = below.pil_image.getchannel("A")
-                if belowAlpha.getpixel((x, y)) == 0:
-                    return
+                x0, y0 = origin
+                height, width = mask.shape[:2]
+                mask[self.layers[idx - 1].alphaPlane()[y0:y0 + height, x0:x0 + width] == 0] = 0
             else:
-                return 
-        targetColour = pixels[x, y]
-        if targetColour == fillColour:
-            return
-
-        def withinBounds(newX, newY):
-            return 0 <= newX < width and 0 <= newY < height
-
-        def colourMatch(c1, c2):
-            return all(abs(a - b) <= tolerance for a, b in zip(c1, c2))
-
-        queue = [(x, y)]
-        visited = set()
-        visited.add((x, y))
-
-        while queue:
-            cx, cy = queue.pop(0)
+                mask[:] = 0  # No layer below to clip to
+        return mask
 
-            if not withinBounds(cx, cy):
-                continue
-            if self.currentLayer.clippingMaskEnabled:
-                if belowAlpha.getpixel((cx, cy)) == 0:
-                    continue
-            # Check selection mask at current point
-            if self.selectionMask and self.selectionMask.getpixel((cx, cy)) == 0:
-                continue
-
-            if not colourMatch(pixels[cx, cy], targetColour):
-                continue
+    def fillMask(self, mask, fillColour, keepAlpha=False, origin=(0, 0)):
+        """
+        Writes the colour into every masked pixel of the current layer, with the mask placed at origin.
+        Returns the rectangle that changed, or None if the mask is empty
+        """
+        rx, ry, rw, rh = cv2.boundingRect(mask)
+        if rw == 0 or rh == 0:
+            return None
+        mask = mask[ry:ry + rh, rx:rx + rw]
+        rx += origin[0]
+        ry += origin[1]
+
+        self.currentLayer.prepareWrite((rx, ry, rx + rw, ry + rh))
+        # Each RGBA pixel written as a single 32 bit word, which is far quicker than four channels
+        packed = self.currentLayer.pixels.view(np.uint32)[..., 0][ry:ry + rh, rx:rx + rw]
+        filled = mask.astype(bool)
+        if keepAlpha:
+            alphaBits = np.array((0, 0, 0, 255), dtype=np.uint8).view(np.uint32)[0]
+            colourBits = np.array(tuple(fillColour[:3]) + (0,), dtype=np.uint8).view(np.uint32)[0]
+            packed[filled] = (packed[filled] & alphaBits) | colourBits
+        else:
+            packed[filled] = np.array(fillColour, dtype=np.uint8).view(np.uint32)[0]
+        return (rx, ry, rx + rw, ry + rh)
 
-            pixels[cx, cy] = fillColour
+    def floodFill(self, x, y, fillColour, tolerance=0, perceptual=False):
+        """
+        Fills all neighboring pixels within a given colour tolerance and selection mask.
+        Matching pixels are found in one pass, then OpenCV grows the connected region from the start point.
+        Returns the rectangle that was filled, or None if nothing changed
+        """
+        pixels = self.currentLayer.pixels
+        height, width = pixels.shape[:2]
 
-            for deltaX, deltaY in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-                newX, newY = cx + deltaX, cy + deltaY
-                if self.currentLayer.clippingMaskEnabled and belowAlpha.getpixel((newX, newY)) == 0:
-                    continue
-                if withinBounds(newX, newY) and (newX, newY) not in visited:
-                    # Check selection mask at neighbor
-                    if self.selectionMask and self.selectionMask.getpixel((newX, newY)) == 0:
-                        continue
-                    queue.append((newX, newY))
-                    visited.add((newX, newY))
+        if not (0 <= x < width and 0 <= y < height):
+            return None
+
+        targetColour = tuple(int(value) for value in pixels[y, x])
+        if targetColour == tuple(fillColour):
+            return None
+
+        # The fill can never leave the selection, so only its bounding box is searched
+        box = self.editableBox()
+        if box is None or not (box[0] <= x < box[2] and box[1] <= y < box[3]):
+            return None  # Start point is not selected
+        x0, y0, x1, y1 = box
+        matching = self.colourMatchMask(pixels[y0:y1, x0:x1], targetColour, tolerance, perceptual, matchAlpha=True)
+        matching = self.limitToEditable(matching, (x0, y0))
+        if matching[y - y0, x - x0] == 0:
+            return None  # Start point is not selected, or is clipped
+
+        # Grow the 4-connected region from the start point into a mask
+        regionMask = np.zeros((y1 - y0 + 2, x1 - x0 + 2), dtype=np.uint8)
+        flags = 4 | cv2.FLOODFILL_MASK_ONLY | cv2.FLOODFILL_FIXED_RANGE | (1 << 8)
+        cv2.floodFill(matching, regionMask, (x - x0, y - y0), 0, 0, 0, flags)
+        return self.fillMask(regionMask[1:-1, 1:-1], fillColour, origin=(x0, y0))
+
+    def replaceColour(self, targetColour, newColour, tolerance=0, perceptual=False, keepAlpha=False):
+        """
+        Recolours every matching pixel on the current layer at once, connected or not.
+        With keepAlpha only the colour changes and each pixel keeps its own transparency.
+        Returns the rectangle that changed, or None if nothing matched
+        """
+        box = self.editableBox()
+        if box is None:
+            return None
+        x0, y0, x1, y1 = box
+        pixels = self.currentLayer.pixels[y0:y1, x0:x1]
+        matching = self.colourMatchMask(pixels, targetColour, tolerance, perceptual, matchAlpha=not keepAlpha)
+        matching = self.limitToEditable(matching, (x0, y0))
+        return self.fillMask(matching, newColour, keepAlpha, (x0, y0))
 
     def setTool(self, toolName, colour=None):
         """
@@ -1335,6 +2185,10 @@ class Canvas(QGraphicsView):
         if isinstance(self.customScene, CustomScene):
             self.customScene.update_zoom(zoomPercentage)
 
+        # Outlines are simplified per zoom band, so retrace once the band changes
+        if self.selectionMask and outlineEpsilon(self.zoomFactor) != self.outlineEpsilon and not self.isSelectionMoving:
+            self.drawSelectionOutline()
+
         self.viewport().update()
 
     def autoZoom(self):
@@ -1374,42 +2228,115 @@ class Canvas(QGraphicsView):
 
     def snapshotLayers(self):
         """
-        Captures and returns a list of the current layers
+        Captures the layer stack along with each layer's name and settings.
+        Pixels are left alone, since adding or removing layers never changes them
         """
-        return [(layer.name, layer.pil_image.copy()) for layer in self.layers]
+        return [(layer, (layer.name, layer.opacity, layer.blendMode, layer.clippingMaskEnabled)) for layer in self.layers]
 
     def restoreLayers(self, layer_data):
         """
-        Clears the current scrrena and reloads the layers
+        Puts the saved layers back in their saved order with their saved settings.
+        The same Layer objects are reused, and only layers that moved or whose settings changed get recomposited
         """
-        self.layers.clear()
-        self.customScene.clear()
-        for name, image in layer_data:
-            layer = Layer(name, image.copy())
-            self.addLayer(layer)
-        self.currentLayer = self.layers[0] if self.layers else None
-        self.viewport().update()
+        for layer in self.layers:
+            layer.canvas = None
+        self.layers[:] = [layer for layer, _ in layer_data]
+        changed = []
+        for layer, settings in layer_data:
+            layer.canvas = self
+            if settings != (layer.name, layer.opacity, layer.blendMode, layer.clippingMaskEnabled):
+                layer.name, layer.opacity, layer.blendMode, layer.clippingMaskEnabled = settings
+                changed.append(layer)
+        if self.currentLayer not in self.layers:
+            self.currentLayer = self.layers[0] if self.layers else None
+        self.releaseAlphaPlanes()
+        self.updateLayerOrder()
+        for layer in changed:
+            self.updateLayerOrder(layer.bounds(), layer)
+
+    def pushUndo(self, description, layer=None):
+        """
+        Starts an undo step for an edit to one layer (the current layer by default).
+        Only the tiles the edit changes are kept once it is finished.
+        Clears the redo stack
+        """
+        layer = layer or self.currentLayer
+        if layer is None:
+            return
+        self.closeUndoStep()
+        print(f"Undo Saved: {description}")
+        self.undoStack.append(TileDeltaEntry(description, layer))
+        self.redoStack.clear()
+        self.trimUndoHistory()
 
-    def pushUndo(self, description):
+    def pushLayersUndo(self, description):
         """
-        Saves the current state of the canvas in the undo stack.
+        Saves the layer stack in the undo stack before layers are added or removed.
         Clears the redo stack
         """
+        self.closeUndoStep()
+        print(f"Undo Saved: {description}")
+        self.undoStack.append(LayerStackEntry(description, self.snapshotLayers()))
+        self.redoStack.clear()
+        self.trimUndoHistory()
+
+    def pushCommand(self, description, undoAction, redoAction, key=None, merge=False):
+        """
+        Saves an exactly reversible operation in the undo stack by its undo and redo actions.
+        Must be called before the operation is carried out.
+        With merge, a run of changes with the same key (such as one slider drag) becomes a single step
+        """
+        self.closeUndoStep()
+        top = self.undoStack[-1] if self.undoStack else None
+        if merge and key is not None and isinstance(top, CommandEntry) and top.key == key and not self.redoStack:
+            top.redoAction = redoAction
+            return
         print(f"Undo Saved: {description}")
-        self.undoStack.append((description, self.snapshotLayers()))
+        self.undoStack.append(CommandEntry(description, undoAction, redoAction, key))
         self.redoStack.clear()
+        self.trimUndoHistory()
+
+    def flipLayer(self, layer, method):
+        """
+        Flips a whole layer with a PIL transpose method, flipping twice gives back the same pixels
+        """
+        layer.pil_image = layer.pil_image.transpose(method)
+        layer.updatePixmap()
+
+    def setLayerSetting(self, layer, setting, value):
+        """
+        Sets a layer setting such as opacity or blendMode and recomposites the layer
+        """
+        setattr(layer, setting, value)
+        self.updateLayerOrder(layer.bounds(), layer)
+
+    def setLayerOrder(self, layers):
+        """
+        Puts the layers in the given order, the compositor only reblends from the first moved layer up
+        """
+        self.layers = list(layers)
+        self.updateLayerOrder()
+
+    def closeUndoStep(self):
+        """
+        Finishes the newest undo step, dropping it if the edit changed nothing
+        """
+        if self.undoStack and not self.undoStack[-1].finish():
+            self.undoStack.pop()
 
     def undo(self):
         """
         Reverts the canvas to the previous saved state from the undo stack.
         """
+        self.closeUndoStep()
         if not self.undoStack:
             print("Nothing to undo.")
             return
-        description, previousState = self.undoStack.pop()
-        self.redoStack.append((description, self.snapshotLayers()))
-        print(f"Undo: {description}")
-        self.restoreLayers(previousState)
+        entry = self.undoStack.pop()
+        print(f"Undo: {entry.description}")
+        entry.swap(self)
+        self.redoStack.append(entry)
+        self.trimUndoHistory()
 
     def redo(self):
         """
@@ -1418,10 +2345,52 @@ class Canvas(QGraphicsView):
         if not self.redoStack:
             print("Nothing to redo.")
             return
-        description, nextState = self.redoStack.pop()
-        self.undoStack.append((description, self.snapshotLayers()))
-        print(f"Redo: {description}")
-        self.restoreLayers(nextState)
+        entry = self.redoStack.pop()
+        print(f"Redo: {entry.description}")
+        entry.swap(self)
+        self.undoStack.append(entry)
+        self.trimUndoHistory()
+
+    def trimUndoHistory(self):
+        """
+        Keeps the newest history as raw pixels within the memory budget, compresses what is older,
+        and moves the oldest out to a temporary file once the compressed history passes its own budget
+        """
+        rawBytes = packedBytes = 0
+        spilled = False
+        for entry in list(reversed(self.undoStack)) + list(reversed(self.redoStack)):
+            for buffer in entry.buffers():
+                if buffer.array is not None:
+                    if rawBytes + buffer.array.nbytes <= self.undoMemoryLimit:
+                        rawBytes += buffer.array.nbytes
+                        continue
+                    buffer.compress()
+                if buffer.packed is not None:
+                    if packedBytes + len(buffer.packed) <= self.undoCompressedLimit:
+                        packedBytes += len(buffer.packed)
+                        continue
+                    if self.undoSpill is None:
+                        self.undoSpill = HistorySpill()
+                    buffer.spill(self.undoSpill)
+                spilled = True
+
+        # Nothing left on disk, so the file can go
+        if not spilled and self.undoSpill is not None:
+            self.undoSpill.close()
+            self.undoSpill = None
+
+        mw = self.window()
+        if hasattr(mw, "updateHistoryReadout"):
+            mw.updateHistoryReadout()
+
+    def historyBytes(self):
+        """
+        Returns how many bytes the undo history holds in memory and on disk
+        """
+        entries = self.undoStack + self.redoStack
+        memory = sum(entry.memoryBytes() for entry in entries)
+        disk = sum(buffer.diskBytes() for entry in entries for buffer in entry.buffers())
+        return memory, disk
 
     def getShapeType(self):
         """
@@ -1441,6 +2410,187 @@ class Canvas(QGraphicsView):
         except:
             return 5
         
+    def liftSelection(self, preview=True):
+        """
+        Cuts the selected pixels (or the whole layer's content without a selection) out of the current layer
+        into a floating item that can be dragged and transformed without touching the layer.
+        Only the bounding box is read or written
+        """
+        layer = self.currentLayer
+        box = self.selectionBounds() if self.selectionMask else layer.bounds()
+        if not box or box[0] >= box[2] or box[1] >= box[3]:
+            return
+        x0, y0, x1, y1 = box
+        self.floatingSnapshot = layer.snapshot()
+        source = layer.pil_image.crop(box)
+        if self.selectionMask:
+            self.floatingMask = self.selectionMask.crop(box)
+            selected, cleared = splitByMask(np.asarray(source), self.floatingMask)
+            self.floatingRegion = Image.fromarray(selected, "RGBA")
+        else:
+            self.floatingMask = None
+            self.floatingRegion = source
+            cleared = 0
+        self.floatingBox = box
+
+        layer.prepareWrite(box)
+        layer.pixels[y0:y1, x0:x1] = cleared
+        layer.updatePixmap(box)
+        self.selectionDragOffset = (0, 0)
+        if not preview:
+            return
+
+        # Large regions are previewed from a reduced copy, the full pixels are only used when dropped
+        preview = self.floatingRegion
+        self.floatingScale = max(1, math.ceil(max(preview.size) / FLOATING_PREVIEW_SIZE))
+        if self.floatingScale > 1:
+            preview = preview.reduce(self.floatingScale)
+        self.floatingItem = QGraphicsPixmapItem(QPixmap.fromImage(arrayToQImage(np.ascontiguousarray(preview))))
+        self.floatingItem.setTransformationMode(Qt.TransformationMode.SmoothTransformation)
+        self.floatingItem.setOpacity(layer.opacity / 255)
+        self.floatingItem.setTransform(self.floatingBase())
+        self.floatingItem.setZValue(500)
+        self.customScene.addItem(self.floatingItem)
+
+    def floatingBase(self):
+        """
+        Returns the transform placing the floating preview over its original bounding box
+        """
+        scale = self.floatingScale
+        return QTransform.fromScale(scale, scale) * QTransform.fromTranslate(self.floatingBox[0], self.floatingBox[1])
+
+    def handleTransform(self, pos):
+        """
+        Returns the scene transform for dragging the current handle to the position,
+        a rotation about the box centre for the rotation handle or a scale anchored on the opposite side
+        """
+        transform = QTransform()
+        if self.currentHandle == 8:
+            centreX, centreY = self.pointOfRotation.x(), self.pointOfRotation.y()
+            currentAngle = math.atan2(pos.y() - centreY, pos.x() - centreX)
+            transform.translate(centreX, centreY)
+            transform.rotate(math.degrees(currentAngle - self.rotationStartAngle))
+            transform.translate(-centreX, -centreY)
+            return transform
+
+        dx = pos.x() - self.dragStartPosition.x()
+        dy = pos.y() - self.dragStartPosition.y()
+        x0, y0, x1, y1 = self.transformBoundingBox
+        width = x1 - x0
+        height = y1 - y0
+        h = self.currentHandle
+
+        # Handles on the left or top grow the box the other way and keep the right or bottom edge still
+        sx = sy = 1.0
+        if h in (1, 2, 5):
+            sx = (width + dx) / width
+        elif h in (0, 3, 7):
+            sx = (width - dx) / width
+        if h in (2, 3, 6):
+            sy = (height + dy) / height
+        elif h in (0, 1, 4):
+            sy = (height - dy) / height
+        originX = x1 if h in (0, 3, 7) else x0
+        originY = y1 if h in (0, 1, 4) else y0
+
+        transform.translate(originX, originY)
+        transform.scale(max(0.01, sx), max(0.01, sy))
+        transform.translate(-originX, -originY)
+        return transform
+
+    def warpFloating(self, transform):
+        """
+        Resamples the floating pixels and mask through the transform in one warp.
+        Returns the warped pixels, warped mask (None without a selection) and the scene position of their top left,
+        or None if the result lands off the canvas
+        """
+        mask = np.asarray(self.floatingMask) if self.floatingMask is not None else None
+        height, width = self.currentLayer.pixels.shape[:2]
+        warp = warpRegion(np.asarray(self.floatingRegion), mask, self.floatingBox, transformMatrix(transform),
+                          TRANSFORM_INTERPOLATION[self.transformInterpolation], (width, height))
+        if warp is None:
+            return None
+        warped, warpedMask, origin = warp
+        return warped, warpedMask, origin
+
+    def placeFloating(self, pixels, x, y):
+        """
+        Lays floating pixels over the current layer at (x, y) with normal blending, clipped to the layer
+        """
+        layer = self.currentLayer
+        height, width = layer.pixels.shape[:2]
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(width, x + pixels.shape[1]), min(height, y + pixels.shape[0])
+        if x0 >= x1 or y0 >= y1:
+            return
+        layer.prepareWrite((x0, y0, x1, y1))
+        target = layer.pixels[y0:y1, x0:x1]
+        blendNormal(target, pixels[y0 - y:y1 - y, x0 - x:x1 - x], 1.0, out=target)
+        layer.updatePixmap((x0, y0, x1, y1))
+
+    def transformSelection(self, transform, description):
+        """
+        Applies an affine transform to the selection, or the whole layer's content without one, in a single resample
+        """
+        if not self.currentLayer:
+            return
+        self.pushUndo(description)
+        self.liftSelection(preview=False)
+        self.dropSelection(transform)
+        if self.transformationHandles:
+            self.showTransformHandles()
+
+    def setSelectionMask(self, mask):
+        """
+        Replaces the selection mask and redraws its outline
+        """
+        self.selectionMask = mask
+        self.drawSelectionOutline()
+
+    def selectionBounds(self):
+        """
+        Returns the selection's bounding box, or None if nothing is selected
+        """
+        return self.selectionMask.getbbox() if self.selectionMask else None
+
+    def dropSelection(self, transform=None):
+        """
+        Writes the floating pixels back into the current layer, moved by the drag offset or through the transform,
+        along with the moved selection mask. If nothing moved, the lifted pixels are put back untouched
+        """
+        if self.floatingItem:
+            self.customScene.removeItem(self.floatingItem)
+            self.floatingItem = None
+        if self.floatingBox is None:
+            return
+        layer = self.currentLayer
+        x0, y0, x1, y1 = self.floatingBox
+        if transform is None:
+            transform = QTransform.fromTranslate(*self.selectionDragOffset)
+
+        if transform.isIdentity():
+            layer.prepareWrite(self.floatingBox)
+            layer.pixels[y0:y1, x0:x1] = self.floatingSnapshot.region(self.floatingBox)
+            layer.updatePixmap(self.floatingBox)
+        else:
+            warp = self.warpFloating(transform)
+            if warp:
+                warped, warpedMask, (outX, outY) = warp
+                self.placeFloating(warped, outX, outY)
+            if self.floatingMask is not None:
+                # Everything selected sat inside the lifted box, so the warped mask is the whole new selection
+                if warp:
+                    self.setSelectionMask(SelectionMask(self.selectionMask.size, warpedMask, (outX, outY)))
+                else:
+                    self.setSelectionMask(SelectionMask(self.selectionMask.size))
+        self.floatingSnapshot.release()
+        self.floatingSnapshot = None
+        self.floatingRegion = None
+        self.floatingMask = None
+        self.floatingBox = None
+        self.floatingScale = 1
+        self.selectionDragOffset = (0, 0)
+
     def normaliseRect(self, pt1, pt2):
         """
         Enables rectangles and circles to use any coordinates,
@@ -1474,23 +2624,42 @@ class Canvas(QGraphicsView):
             print("Final selection rect:", self.selectionRectangle)
 
     def animateSelection(self):
-        if self.selectionItem:
-            self.selectionLineDashes = (self.selectionLineDashes + 1) % 20
-            pen = self.selectionItem.pen()
-            pen.setDashOffset(self.selectionLineDashes)
-            self.selectionItem.setPen(pen)
-            self.viewport().update()
-        if not self.selectionItem or not self.selectionRectangle:
+        """
+        Steps the marching ants. Setting the pen only repaints the outline's own area, and the timer stops once there is nothing to animate
+        """
+        if not self.selectionItem or not self.isVisible():
+            self.selectionLineAnimation.stop()
             return
+        self.selectionLineDashes = (self.selectionLineDashes + 1) % 20
+        pen = self.selectionItem.pen()
+        pen.setDashOffset(self.selectionLineDashes)
+        self.selectionItem.setPen(pen)
+
+    def updateSelectionAnimation(self):
+        """
+        Runs the marching ants only while this canvas is showing a selection outline
+        """
+        if self.selectionItem and self.isVisible():
+            if not self.selectionLineAnimation.isActive():
+                self.selectionLineAnimation.start()
+        else:
+            self.selectionLineAnimation.stop()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.updateSelectionAnimation()
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.updateSelectionAnimation()
+
     def generateSelectionMask(self):
         if not self.selectionRectangle:
             return
 
-        width, height = self.sceneWidth, self.sceneHeight
-        newMask = Image.new("L", (width, height), 0)
         rect = self.selectionRectangle.toRect()
         x, y, w, h = rect.x(), rect.y(), rect.width(), rect.height()
-        ImageDraw.Draw(newMask).rectangle([x, y, x + w, y + h], fill=255)
+        newMask = SelectionMask.rectangle((self.sceneWidth, self.sceneHeight), (x, y, x + w + 1, y + h + 1))
 
         self.selectionMask = self.combineSelectionMasks(newMask)
 
@@ -1500,11 +2669,20 @@ class Canvas(QGraphicsView):
             return
 
         layer = canvas.currentLayer
-        img = layer.pil_image.convert("RGBA")
-
-        r, g, b, a = img.split()
-        newAlpha = ImageChops.multiply(a, canvas.selectionMask)
-        layer.pil_image = Image.merge("RGBA", (r, g, b, newAlpha))
+        layer.prepareWrite()
+        alpha = layer.pixels[..., 3]
+        box = canvas.selectionBounds()
+        if box is None:
+            alpha[...] = 0
+        else:
+            # Everything outside the selection's box is cleared outright, only the box is multiplied
+            x0, y0, x1, y1 = box
+            inside = alpha[y0:y1, x0:x1].astype(np.uint16) * canvas.selectionMask.local // 255
+            alpha[:y0] = 0
+            alpha[y1:] = 0
+            alpha[y0:y1, :x0] = 0
+            alpha[y0:y1, x1:] = 0
+            alpha[y0:y1, x0:x1] = inside
 
         layer.updatePixmap()
         canvas.viewport().update()
@@ -1513,62 +2691,80 @@ class Canvas(QGraphicsView):
             return
 
         width, height = self.sceneWidth, self.sceneHeight
-        newMask = Image.new("L", (width, height), 0)
         rect = self.selectionRectangle.toRect()
         x, y, w, h = rect.x(), rect.y(), rect.width(), rect.height()
-        ImageDraw.Draw(newMask).rectangle([x, y, x + w, y + h], fill=255)
+        newMask = SelectionMask.rectangle((width, height), (x, y, x + w + 1, y + h + 1))
 
         if modifiers & Qt.KeyboardModifier.ControlModifier:
             if self.selectionMask:
-                self.selectionMask = ImageChops.lighter(self.selectionMask, newMask)
+                self.selectionMask = self.selectionMask.combine(newMask, "add")
             else:
                 self.selectionMask = newMask
             print("Added to selection.")
         elif modifiers & Qt.KeyboardModifier.ShiftModifier:
             if self.selectionMask:
-                inverted = ImageChops.invert(newMask)
-                self.selectionMask = ImageChops.multiply(self.selectionMask, inverted)
+                self.selectionMask = self.selectionMask.combine(newMask, "subtract")
             else:
-                self.selectionMask = Image.new("L", (width, height), 0)
+                self.selectionMask = SelectionMask((width, height))
             print("Subtracted from selection.")
         else:
             self.selectionMask = newMask
             print("Replaced selection.")
 
-        if self.selectionItem:
-            self.customScene.removeItem(self.selectionItem)
-            self.selectionItem = None
-
         # Regenerate the selection outline from the final mask
-        mask_np = np.array(self.selectionMask)
-        contours = cv2.findContours(mask_np, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)[0]
-
-        path = QPainterPath()
-        for contour in contours:
-            if len(contour) >= 2:
-                contour = contour.squeeze()
-                if len(contour.shape) == 1:
-                    path.moveTo(contour[0], contour[1])
-                else:
-                    path.moveTo(contour[0][0], contour[0][1])
-                    for pt in contour[1:]:
-                        path.lineTo(pt[0], pt[1])
-
-        self.selectionItem = QGraphicsPathItem(path)
-        pen = QPen(QColor(0, 120, 215), 1, Qt.PenStyle.DashLine)
-        pen.setCosmetic(True)
-        pen.setDashPattern([4, 4])
-        pen.setDashOffset(self.selectionLineDashes)
-        self.selectionItem.setPen(pen)
-        self.selectionItem.setBrush(QBrush(Qt.BrushStyle.NoBrush))
-        self.selectionItem.setZValue(1000)
-        self.customScene.addItem(self.selectionItem)
+        self.drawSelectionOutline()
         print("Marquee selection finalized.")
 
 
+    def addLassoPoint(self, pos):
+        """
+        Adds a point to the lasso, then schedules the preview for the next refresh.
+        Points under a screen pixel from the last one are skipped, and points carrying on in a straight line
+        replace the last one while every point they replace stays within half a screen pixel of the new edge
+        """
+        last = self.lassoPoints[-1]
+        tolerance = 1 / self.zoomFactor
+        if math.hypot(pos.x() - last.x(), pos.y() - last.y()) < tolerance:
+            return
+
+        # The cone holds the directions from the previous corner that keep every replaced point close enough
+        anchor = self.lassoPoints[-2] if len(self.lassoPoints) > 1 else last
+        dx, dy = pos.x() - anchor.x(), pos.y() - anchor.y()
+        distance = math.hypot(dx, dy)
+        offset = None
+        # Doubling back onto the previous corner starts a new corner rather than narrowing the cone
+        if self.lassoCone and distance > 0:
+            spread = math.asin(min(1.0, 0.5 * tolerance / distance))
+            offset = (math.atan2(dy, dx) - self.lassoCone[0]) % (2 * math.pi)
+
+        if offset is not None and offset <= self.lassoCone[1]:
+            low, high = max(0.0, offset - spread), min(self.lassoCone[1], offset + spread)
+            self.lassoCone = (self.lassoCone[0] + low, high - low)
+            self.lassoPoints[-1] = pos
+            self.lassoDrawn = min(self.lassoDrawn, len(self.lassoPoints) - 1)
+        else:
+            self.lassoPoints.append(pos)
+            dx, dy = pos.x() - last.x(), pos.y() - last.y()
+            spread = math.asin(min(1.0, 0.5 * tolerance / math.hypot(dx, dy)))
+            self.lassoCone = (math.atan2(dy, dx) - spread, 2 * spread)
+
+        if not self.lassoTimer.isActive():
+            self.lassoTimer.start(self.frameInterval())
+
+    def flushLassoPreview(self):
+        """
+        Extends the lasso preview with the points added since the last refresh
+        """
+        if not self.lassoPathItem or self.lassoDrawn >= len(self.lassoPoints):
+            return
+        path = self.lassoPathItem.path()
+        for point in self.lassoPoints[self.lassoDrawn:]:
+            path.lineTo(point)
+        self.lassoDrawn = len(self.lassoPoints)
+        self.lassoPathItem.setPath(path)
+
     def finaliseLassoSelection(self, modifiers=Qt.KeyboardModifier.NoModifier):
         width, height = self.sceneWidth, self.sceneHeight
-        newMask = Image.new("L", (width, height), 0)
 
         polygon = [(pt.x(), pt.y()) for pt in self.lassoPoints]
         if len(polygon) < 3:
@@ -1576,58 +2772,32 @@ class Canvas(QGraphicsView):
         if polygon[0] != polygon[-1]:
             polygon.append(polygon[0])  # close the shape
 
-        ImageDraw.Draw(newMask).polygon(polygon, fill=255)
+        newMask = SelectionMask.polygon((width, height), polygon)
 
         # Combine with existing selection mask
         if modifiers & Qt.KeyboardModifier.ControlModifier:
             if self.selectionMask:
-                self.selectionMask = ImageChops.lighter(self.selectionMask, newMask)
+                self.selectionMask = self.selectionMask.combine(newMask, "add")
             else:
                 self.selectionMask = newMask
             print("Added to selection.")
         elif modifiers & Qt.KeyboardModifier.ShiftModifier:
             if self.selectionMask:
-                inverted = ImageChops.invert(newMask)
-                self.selectionMask = ImageChops.multiply(self.selectionMask, inverted)
+                self.selectionMask = self.selectionMask.combine(newMask, "subtract")
             else:
-                self.selectionMask = Image.new("L", (width, height), 0)
+                self.selectionMask = SelectionMask((width, height))
             print("Subtracted from selection.")
         else:
             self.selectionMask = newMask
             print("Replaced selection.")
 
         # Remove old selection visuals
-        if self.selectionItem:
-            self.customScene.removeItem(self.selectionItem)
-            self.selectionItem = None
         if self.lassoPathItem:
             self.customScene.removeItem(self.lassoPathItem)
             self.lassoPathItem = None
 
         # Create visual outline of entire combined selection
-        mask_np = np.array(self.selectionMask)
-        contours = cv2.findContours(mask_np, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)[0]
-
-        path = QPainterPath()
-        for contour in contours:
-            if len(contour) >= 2:
-                contour = contour.squeeze()
-                if len(contour.shape) == 1:
-                    path.moveTo(contour[0], contour[1])
-                else:
-                    path.moveTo(contour[0][0], contour[0][1])
-                    for pt in contour[1:]:
-                        path.lineTo(pt[0], pt[1])
-
-        self.selectionItem = QGraphicsPathItem(path)
-        pen = QPen(QColor(0, 120, 215), 1, Qt.PenStyle.DashLine)
-        pen.setCosmetic(True)
-        pen.setDashPattern([4, 4])
-        pen.setDashOffset(self.selectionLineDashes)
-        self.selectionItem.setPen(pen)
-        self.selectionItem.setBrush(QBrush(Qt.BrushStyle.NoBrush))
-        self.selectionItem.setZValue(1000)
-        self.customScene.addItem(self.selectionItem)
+        self.drawSelectionOutline()
         print("Lasso selection finalized.")
 
     def clearSelection(self):
@@ -1643,54 +2813,82 @@ class Canvas(QGraphicsView):
             self.customScene.removeItem(self.lassoPathItem)
             self.lassoPathItem = None
 
+        self.updateSelectionAnimation()
         print("Selection cleared.")
 
     def combineSelectionMasks(self, newMask):
 
-        if self.selectionMode == "add" and self.selectionMask:
-            return ImageChops.lighter(self.selectionMask, newMask)
-        elif self.selectionMode == "subtract" and self.selectionMask:
-            return ImageChops.subtract(self.selectionMask, newMask)
+        if self.selectionMode in ("add", "subtract") and self.selectionMask:
+            return self.selectionMask.combine(newMask, self.selectionMode)
         else:  # "replace" or no existing mask
             return newMask
         
-    def selectAllColour(self, targetColour):
-        width, height = self.sceneWidth, self.sceneHeight
-        img = self.currentLayer.pil_image.convert("RGBA")
-        pixels = np.array(img)
+    def wandPixels(self):
+        """
+        Returns the pixels the magic wand reads, the current layer or the merged image of every layer
+        """
+        if self.wandSample == "merged":
+            # Bring the composite up to date with any strokes still waiting for the next refresh
+            self.flushDisplayUpdate()
+            self.updateLayerOrder()
+            return self.compositor.output
+        return self.currentLayer.pixels
+
+    def wandMask(self, pixels, targetColour, seed=None, matchAlpha=True):
+        """
+        Returns a selection of the pixels within the wand's tolerance of the colour, and of its alpha with matchAlpha.
+        In contiguous mode with a seed point, only the 4-connected region around the seed is kept.
+        Anti-aliasing softens the selection's edge by a pixel
+        """
+        height, width = pixels.shape[:2]
+        matching = self.colourMatchMask(pixels, targetColour, self.wandTolerance, matchAlpha=matchAlpha)
+
+        if seed is not None and self.wandMode == "contiguous":
+            regionMask = np.zeros((height + 2, width + 2), dtype=np.uint8)
+            flags = 4 | cv2.FLOODFILL_MASK_ONLY | cv2.FLOODFILL_FIXED_RANGE | (255 << 8)
+            cv2.floodFill(matching, regionMask, seed, 0, 0, 0, flags)
+            matching = regionMask[1:-1, 1:-1]
+
+        if self.wandAntiAlias:
+            # Only the selected box grown by the blur's reach can change. The crop keeps a second empty ring
+            # so the reflected border reads zeros, as it would inside the full canvas
+            bx, by, bw, bh = cv2.boundingRect(matching)
+            if bw and bh:
+                x0, y0 = max(0, bx - 2), max(0, by - 2)
+                x1, y1 = min(width, bx + bw + 2), min(height, by + bh + 2)
+                matching = np.ascontiguousarray(matching[y0:y1, x0:x1])
+                return SelectionMask((self.sceneWidth, self.sceneHeight), cv2.GaussianBlur(matching, (3, 3), 0), (x0, y0))
+
+        return SelectionMask((self.sceneWidth, self.sceneHeight), matching)
+
+    def magicWandSelect(self, x, y):
+        """
+        Selects the colour under the point, combined with the current selection by the press's add/subtract mode
+        """
+        if not self.currentLayer:
+            return
+        pixels = self.wandPixels()
+        height, width = pixels.shape[:2]
+        if not (0 <= x < width and 0 <= y < height):
+            return
 
-        match = np.all(pixels[:, :, :3] == targetColour[:3], axis=-1)
-        newMask_np = np.where(match, 255, 0).astype(np.uint8)
-        newMask = Image.fromarray(newMask_np, mode="L")
+        targetColour = tuple(int(value) for value in pixels[y, x])
+        self.selectionMask = self.combineSelectionMasks(self.wandMask(pixels, targetColour, (x, y)))
 
-        self.selectionMask = ImageChops.lighter(self.selectionMask, newMask) if self.selectionMask else newMask
+        self.drawSelectionOutline()
+        print(f"Magic wand selected {targetColour} at ({x}, {y})")
 
-        # Regenerate selection outline
-        if self.selectionItem:
-            self.customScene.removeItem(self.selectionItem)
-            self.selectionItem = None
+    def selectAllColour(self, targetColour):
+        """
+        Adds every pixel within the wand's tolerance of the colour to the selection, wherever it is.
+        Only RGB is compared, so the colour is selected at any opacity
+        """
+        newMask = self.wandMask(self.wandPixels(), targetColour, matchAlpha=False)
 
-        contours, _ = cv2.findContours(newMask_np, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
-        path = QPainterPath()
-        for contour in contours:
-            if len(contour) >= 2:
-                contour = contour.squeeze()
-                if len(contour.shape) == 1:
-                    continue
-                path.moveTo(contour[0][0], contour[0][1])
-                for pt in contour[1:]:
-                    path.lineTo(pt[0], pt[1])
-                path.closeSubpath()
+        self.selectionMask = self.selectionMask.combine(newMask, "add") if self.selectionMask else newMask
 
-        self.selectionItem = QGraphicsPathItem(path)
-        pen = QPen(QColor(0, 120, 215), 1, Qt.PenStyle.DashLine)
-        pen.setCosmetic(True)
-        pen.setDashPattern([4, 4])
-        pen.setDashOffset(self.selectionLineDashes)
-        self.selectionItem.setPen(pen)
-        self.selectionItem.setBrush(QBrush(Qt.BrushStyle.NoBrush))
-        self.selectionItem.setZValue(1000)
-        self.customScene.addItem(self.selectionItem)
+        # Regenerate selection outline
+        self.drawSelectionOutline()
 
         print(f"Selected all pixels of colour {targetColour}")
 
@@ -1705,7 +2903,7 @@ class Canvas(QGraphicsView):
 
         # Get bounding box: selection or full layer
         if self.selectionMask:
-            bbox = self.selectionMask.getbbox()
+            bbox = self.selectionBounds()
             if not bbox:
                 return
             x0, y0, x1, y1 = bbox
@@ -1754,21 +2952,24 @@ class Canvas(QGraphicsView):
             self.customScene.removeItem(handle)
         self.transformationHandles.clear()
     def drawSelectionOutline(self):
-        if not self.selectionMask:
+        """
+        Replaces the marching ants with the current selection's outline.
+        Outlines come from the shared outline service, simplified for the zoom level. While a large one is
+        still being traced, the selection's bounding box stands in for it
+        """
+        if self.selectionItem:
+            self.customScene.removeItem(self.selectionItem)
+            self.selectionItem = None
+        if not self.selectionMask or self.selectionMask.getbbox() is None:
+            self.updateSelectionAnimation()
             return
 
-        mask_np = np.array(self.selectionMask)
-        contours, _ = cv2.findContours(mask_np, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
-
-        path = QPainterPath()
-        for contour in contours:
-            contour = contour.squeeze()
-            if contour.ndim != 2:
-                continue
-            path.moveTo(contour[0][0], contour[0][1])
-            for pt in contour[1:]:
-                path.lineTo(pt[0], pt[1])
-            path.closeSubpath()
+        self.outlineEpsilon = outlineEpsilon(self.zoomFactor)
+        path = OUTLINES.outline(self.selectionMask, self.outlineEpsilon)
+        if path is None:
+            x0, y0, x1, y1 = self.selectionMask.getbbox()
+            path = QPainterPath()
+            path.addRect(QRectF(x0, y0, x1 - x0, y1 - y0))
 
         self.selectionItem = QGraphicsPathItem(path)
         pen = QPen(QColor(0, 120, 215), 1, Qt.PenStyle.DashLine)
@@ -1779,6 +2980,16 @@ class Canvas(QGraphicsView):
         self.selectionItem.setBrush(QBrush(Qt.BrushStyle.NoBrush))
         self.selectionItem.setZValue(1000)
         self.customScene.addItem(self.selectionItem)
+        self.updateSelectionAnimation()
+
+    def onOutlineReady(self, key):
+        """
+        Swaps the stand in box for the traced outline once it belongs to the current selection and zoom
+        """
+        if self.isSelectionMoving or self.currentHandle is not None:
+            return  # Redrawn when the drag is released
+        if self.selectionMask and key == (self.selectionMask.version, self.outlineEpsilon):
+            self.drawSelectionOutline()
 
 
 
@@ -1935,6 +3146,20 @@ class FillOptions(QWidget):
         super().__init__(parent)
         layout = QHBoxLayout(self)
         layout.addWidget(QLabel("Fill Tool"))
+        layout.addWidget(QLabel("Tolerance:"))
+        self.fillToleranceSlider = QSlider(Qt.Orientation.Horizontal)
+        self.fillToleranceSlider.setMinimum(0)
+        self.fillToleranceSlider.setMaximum(255)
+        self.fillToleranceSlider.setValue(0)
+        layout.addWidget(self.fillToleranceSlider)
+        layout.addWidget(QLabel("Mode:"))
+        self.fillModeSelector = QComboBox()
+        self.fillModeSelector.addItems(["Contiguous", "All Matching", "Replace Colour"])
+        layout.addWidget(self.fillModeSelector)
+        layout.addWidget(QLabel("Match:"))
+        self.fillDistanceSelector = QComboBox()
+        self.fillDistanceSelector.addItems(["RGB", "Perceptual"])
+        layout.addWidget(self.fillDistanceSelector)
 
 class ShapeOptions(QWidget):
     def __init__(self, parent=None):
@@ -1962,6 +3187,11 @@ class TransformOptions(QWidget):
         layout.addWidget(self.flipVerticalButton)
         self.shearButton = QPushButton("Shear")
         layout.addWidget(self.shearButton)
+        layout.addWidget(QLabel("Interpolation:"))
+        self.interpolationSelector = QComboBox()
+        self.interpolationSelector.addItems(TRANSFORM_INTERPOLATION.keys())
+        self.interpolationSelector.setCurrentText("Bicubic")
+        layout.addWidget(self.interpolationSelector)
 
 class SelectionOptions(QWidget):
     def __init__(self, parent = None):
@@ -1976,9 +3206,29 @@ class SelectionOptions(QWidget):
         layout.addWidget(self.lassoButton)
         self.deselectButton = QPushButton("deselect")
         layout.addWidget(self.deselectButton)
+        self.wandButton = QPushButton("Magic Wand")
+        self.wandButton.setCheckable(True)
+        layout.addWidget(self.wandButton)
         self.selectButton = QPushButton("Select by Colour")
         layout.addWidget(self.selectButton)
         self.selectedColour = QColor(0, 0, 0, 255)
+        layout.addWidget(QLabel("Tolerance:"))
+        self.wandToleranceSlider = QSlider(Qt.Orientation.Horizontal)
+        self.wandToleranceSlider.setMinimum(0)
+        self.wandToleranceSlider.setMaximum(255)
+        self.wandToleranceSlider.setValue(32)
+        layout.addWidget(self.wandToleranceSlider)
+        self.wandModeSelector = QComboBox()
+        self.wandModeSelector.addItems(["Contiguous", "All Matching"])
+        layout.addWidget(self.wandModeSelector)
+        layout.addWidget(QLabel("Sample:"))
+        self.wandSampleSelector = QComboBox()
+        self.wandSampleSelector.addItems(["Current Layer", "All Layers"])
+        layout.addWidget(self.wandSampleSelector)
+        self.wandAntiAliasButton = QPushButton("Anti-alias")
+        self.wandAntiAliasButton.setCheckable(True)
+        self.wandAntiAliasButton.setChecked(True)
+        layout.addWidget(self.wandAntiAliasButton)
 
 
 def generateLayerName(existingNames, prefix="Layer"):
@@ -1994,10 +3244,15 @@ class MainWindow(QMainWindow):
         self.setWindowTitle("Iteration 3")
         self.resize(1200, 800)
 
+        # Undo history size readout
+        self.historyLabel = QLabel("History: 0.0 MB in memory, 0.0 MB on disk")
+        self.statusBar().addPermanentWidget(self.historyLabel)
+
         # Central tab widget holds multiple canvas tabs.
         self.tabWidget = QTabWidget(self)
         self.setCentralWidget(self.tabWidget)
         self.tabWidget.currentChanged.connect(self.updateLayerList)
+        self.tabWidget.currentChanged.connect(self.updateHistoryReadout)
         self.tabWidget.setTabsClosable(True)
         self.tabWidget.tabCloseRequested.connect(self.closeTab)
 
@@ -2046,6 +3301,9 @@ class MainWindow(QMainWindow):
         self.toolOptionsStack.addWidget(self.move_options)
 
         self.toolOptionsStack.addWidget(self.fill_options)
+        self.fill_options.fillToleranceSlider.valueChanged.connect(self.updateFillTolerance)
+        self.fill_options.fillModeSelector.currentTextChanged.connect(self.updateFillMode)
+        self.fill_options.fillDistanceSelector.currentTextChanged.connect(self.updateFillDistance)
 
         self.toolOptionsStack.addWidget(self.shape_options)
 
@@ -2053,10 +3311,16 @@ class MainWindow(QMainWindow):
         self.transform_options.flipHorizontalButton.clicked.connect(self.flipHorizontal)
         self.transform_options.flipVerticalButton.clicked.connect(self.flipVertical)
         self.transform_options.shearButton.clicked.connect(self.showShearDialog)
+        self.transform_options.interpolationSelector.currentTextChanged.connect(self.updateTransformInterpolation)
 
         self.toolOptionsStack.addWidget(self.selection_options)
         self.selection_options.marqueeButton.clicked.connect(lambda: self.setSelectionTool("marquee"))
         self.selection_options.lassoButton.clicked.connect(lambda: self.setSelectionTool("lasso"))
+        self.selection_options.wandButton.clicked.connect(lambda: self.setSelectionTool("wand"))
+        self.selection_options.wandToleranceSlider.valueChanged.connect(self.updateWandTolerance)
+        self.selection_options.wandModeSelector.currentTextChanged.connect(self.updateWandMode)
+        self.selection_options.wandSampleSelector.currentTextChanged.connect(self.updateWandSample)
+        self.selection_options.wandAntiAliasButton.toggled.connect(self.updateWandAntiAlias)
         self.selection_options.deselectButton.clicked.connect(self.clearSelection)
         self.selection_options.selectButton.clicked.connect(self.selectByColour)
 
@@ -2116,6 +3380,7 @@ class MainWindow(QMainWindow):
 
         self.globalGridEnabled = False
         self.globalRulerEnabled = False
+        self.globalHistoryLimit = UNDO_MEMORY_LIMIT
 
         # Add the initial canvas tab.
         self.addNewCanvas(canvasWidth, canvasHeight, bgImg)
@@ -2167,6 +3432,10 @@ class MainWindow(QMainWindow):
         pasteAction.setShortcut("Ctrl+V")
         pasteAction.triggered.connect(self.pasteClipboard)
         editMenu.addAction(pasteAction)
+        editMenu.addSeparator()
+        historyLimitAction = QAction("History Memory Limit...", self)
+        historyLimitAction.triggered.connect(self.setHistoryLimit)
+        editMenu.addAction(historyLimitAction)
 
         viewMenu = menubar.addMenu("View")
         self.toggleGridAction = QAction("Show Grid", self, checkable=True)
@@ -2200,6 +3469,9 @@ class MainWindow(QMainWindow):
         self.layerOpacitySlider.setMaximum(255)
         self.layerOpacitySlider.setValue(255)
         self.layerOpacitySlider.valueChanged.connect(self.changeLayerOpacity)
+        # Each press of the slider starts a new drag, so two drags never merge into one undo step
+        self.opacityDrag = 0
+        self.layerOpacitySlider.sliderPressed.connect(self.startOpacityDrag)
         rightLayout.addWidget(self.opacityLabel)
         rightLayout.addWidget(self.layerOpacitySlider)
         self.clippingMaskBtn = QPushButton("Enable Clipping Mask")
@@ -2228,6 +3500,7 @@ class MainWindow(QMainWindow):
             canvasWidth, canvasHeight, gridEnabled=self.globalGridEnabled,rulerEnabled=self.globalRulerEnabled,
             bgImg=bgImg
         )
+        tab.canvas.undoMemoryLimit = self.globalHistoryLimit
         self.tabWidget.addTab(tab, f"Canvas {self.tabWidget.count()+1}")
         self.tabWidget.setCurrentWidget(tab)
         self.updateLayerList()
@@ -2370,7 +3643,7 @@ class MainWindow(QMainWindow):
 
         try:
             image = Image.open(FileName).convert("RGBA")
-            canvas.pushUndo("Add Image Layer")
+            canvas.pushLayersUndo("Add Image Layer")
             layerName = f"Layer {len(canvas.layers) + 1}"
             layer = Layer(layerName, image)
             canvas.addLayer(layer)
@@ -2418,7 +3691,7 @@ class MainWindow(QMainWindow):
         canvas = self.currentCanvas()
         if not canvas:
             return
-        canvas.pushUndo("Add Blank Layer")
+        canvas.pushLayersUndo("Add Blank Layer")
         cw, ch = canvas.sceneWidth, canvas.sceneHeight
         image = Image.new("RGBA", (cw, ch), (0, 0, 0, 0))
         existingNames = [layer.name for layer in canvas.layers]
@@ -2439,15 +3712,12 @@ class MainWindow(QMainWindow):
         indexes2Remove = [self.layerList.row(item) for item in selectedItems]
         indexes2Remove.sort(reverse=True)  # Delete from highest index down
 
-        canvas.pushUndo("Delete Layer")
+        canvas.pushLayersUndo("Delete Layer")
 
         for index in indexes2Remove:
             if 0 <= index < len(canvas.layers):
-                layer = canvas.layers[index]
-                # Remove from scene
-                if layer.graphicsItem:
-                    canvas.customScene.removeItem(layer.graphicsItem)
-                canvas.layers.pop(index)
+                layer = canvas.layers.pop(index)
+                layer.canvas = None
 
         # Reassign current layer safely
         if canvas.layers:
@@ -2457,7 +3727,6 @@ class MainWindow(QMainWindow):
 
         self.updateLayerList()
         canvas.updateLayerOrder()
-        canvas.viewport().update()
 
     def changeLayerOpacity(self, value):
         canvas = self.currentCanvas()
@@ -2465,17 +3734,29 @@ class MainWindow(QMainWindow):
             return
 
         layer = canvas.currentLayer
-        layer.opacity = value
-        layer.updatePixmap()
+        if layer.opacity == value:
+            return
+        # One drag of the slider is one undo step
+        canvas.pushCommand("Layer Opacity", partial(canvas.setLayerSetting, layer, "opacity", layer.opacity),
+                           partial(canvas.setLayerSetting, layer, "opacity", value),
+                           key=("opacity", layer, self.opacityDrag), merge=self.layerOpacitySlider.isSliderDown())
+        canvas.setLayerSetting(layer, "opacity", value)
         canvas.viewport().update()
+
+    def startOpacityDrag(self):
+        self.opacityDrag += 1
     
     def changeLayerBlendMode(self, mode):
         canvas = self.currentCanvas()
         if not canvas or not canvas.currentLayer:
             return
 
-        canvas.currentLayer.blendMode = mode
-        canvas.updateLayerOrder()
+        layer = canvas.currentLayer
+        if layer.blendMode == mode:
+            return
+        canvas.pushCommand("Blend Mode", partial(canvas.setLayerSetting, layer, "blendMode", layer.blendMode),
+                           partial(canvas.setLayerSetting, layer, "blendMode", mode))
+        canvas.setLayerSetting(layer, "blendMode", mode)
 
     def onLayersReordered(self, parent, start, end, destination, row):
         canvas = self.currentCanvas()
@@ -2488,8 +3769,11 @@ class MainWindow(QMainWindow):
                 if layer.name == name:
                     newOrder.append(layer)
                     break
-        canvas.layers = newOrder
-        canvas.updateLayerOrder()
+        if newOrder == canvas.layers:
+            return
+        canvas.pushCommand("Reorder Layers", partial(canvas.setLayerOrder, list(canvas.layers)),
+                           partial(canvas.setLayerOrder, newOrder))
+        canvas.setLayerOrder(newOrder)
 
     def onLayerSelectionChanged(self, currentRow):
         canvas = self.currentCanvas()
@@ -2529,10 +3813,31 @@ class MainWindow(QMainWindow):
 
         layer = currentCanvas.currentLayer
         layer.clippingMaskEnabled = not layer.clippingMaskEnabled
+        currentCanvas.releaseAlphaPlanes()
 
         status = "enabled" if layer.clippingMaskEnabled else "disabled"
         QMessageBox.information(self, "Clipping Mask", f"Clipping mask {status} for layer: {layer.name}")
 
+    def setHistoryLimit(self):
+        limit, ok = QInputDialog.getInt(self, "History Memory Limit", "Uncompressed undo history (MB):",
+                                        self.globalHistoryLimit // (1024 * 1024), 16, 65536)
+        if not ok:
+            return
+        self.globalHistoryLimit = limit * 1024 * 1024
+        for i in range(self.tabWidget.count()):
+            tab = self.tabWidget.widget(i)
+            if hasattr(tab, "canvas"):
+                tab.canvas.undoMemoryLimit = self.globalHistoryLimit
+                tab.canvas.trimUndoHistory()
+
+    def updateHistoryReadout(self):
+        """
+        Shows how much the current canvas's undo history is holding
+        """
+        canvas = self.currentCanvas()
+        memory, disk = canvas.historyBytes() if canvas else (0, 0)
+        self.historyLabel.setText(f"History: {memory / (1024 * 1024):.1f} MB in memory, {disk / (1024 * 1024):.1f} MB on disk")
+
     def toggleGrid(self):
         self.globalGridEnabled = self.toggleGridAction.isChecked()
         for i in range(self.tabWidget.count()):
@@ -2551,13 +3856,15 @@ class MainWindow(QMainWindow):
         canvas = self.currentCanvas()
         if canvas:
             canvas.undo()
-            self.updateLayerList() 
+            self.updateLayerList()
+            self.onLayerSelectionChanged(0) 
 
     def redoUI(self):
         canvas = self.currentCanvas()
         if canvas:
             canvas.redo()
             self.updateLayerList()
+            self.onLayerSelectionChanged(0)
     
     def updateEraserSize(self, value):
         print(f"[DEBUG] New eraser size: {value}")
@@ -2595,6 +3902,30 @@ class MainWindow(QMainWindow):
         if canvas:
             canvas.brushSpacing = value
 
+    def updateFillTolerance(self, value):
+        print(f"[DEBUG] New fill tolerance: {value}")
+        canvas = self.currentCanvas()
+        if canvas:
+            canvas.fillTolerance = value
+
+    def updateFillMode(self, mode):
+        print(f"[DEBUG] New fill mode: {mode}")
+        canvas = self.currentCanvas()
+        if canvas:
+            canvas.fillMode = {"Contiguous": "contiguous", "All Matching": "all", "Replace Colour": "replace"}[mode]
+
+    def updateFillDistance(self, distance):
+        print(f"[DEBUG] New fill match: {distance}")
+        canvas = self.currentCanvas()
+        if canvas:
+            canvas.fillDistance = distance.lower()
+
+    def updateTransformInterpolation(self, interpolation):
+        print(f"[DEBUG] New transform interpolation: {interpolation}")
+        canvas = self.currentCanvas()
+        if canvas:
+            canvas.transformInterpolation = interpolation
+
     def updateEraserSpacing(self, value):
         print(f"[DEBUG] New brush: {value}")
         canvas = self.currentCanvas()
@@ -2663,6 +3994,30 @@ class MainWindow(QMainWindow):
         if canvas:
             canvas.selectionTool = mode
 
+    def updateWandTolerance(self, value):
+        print(f"[DEBUG] New wand tolerance: {value}")
+        canvas = self.currentCanvas()
+        if canvas:
+            canvas.wandTolerance = value
+
+    def updateWandMode(self, mode):
+        print(f"[DEBUG] New wand mode: {mode}")
+        canvas = self.currentCanvas()
+        if canvas:
+            canvas.wandMode = {"Contiguous": "contiguous", "All Matching": "all"}[mode]
+
+    def updateWandSample(self, sample):
+        print(f"[DEBUG] New wand sample: {sample}")
+        canvas = self.currentCanvas()
+        if canvas:
+            canvas.wandSample = {"Current Layer": "layer", "All Layers": "merged"}[sample]
+
+    def updateWandAntiAlias(self, enabled):
+        print(f"[DEBUG] New wand anti-alias: {enabled}")
+        canvas = self.currentCanvas()
+        if canvas:
+            canvas.wandAntiAlias = enabled
+
     def clearSelection(self):
         canvas = self.currentCanvas()
         if canvas:
@@ -2689,12 +4044,15 @@ class MainWindow(QMainWindow):
             return
 
         layer = canvas.currentLayer
-        mask = canvas.selectionMask
-        source = layer.pil_image.copy()
-
-        # Apply the mask to isolate selected pixels
-        blank = Image.new("RGBA", source.size, (0, 0, 0, 0))
-        self.selectionClipboard = Image.composite(source, blank, mask)
+        source = layer.pil_image
+
+        # Apply the mask to isolate selected pixels, only the selection's box needs compositing
+        self.selectionClipboard = Image.new("RGBA", source.size, (0, 0, 0, 0))
+        box = canvas.selectionBounds()
+        if box:
+            x0, y0, x1, y1 = box
+            selected, _ = splitByMask(layer.pixels[y0:y1, x0:x1], canvas.selectionMask.region(box))
+            self.selectionClipboard.paste(Image.fromarray(selected, "RGBA"), box[:2])
         print("Selection copied.")
 
     def cutSelection(self):
@@ -2704,10 +4062,14 @@ class MainWindow(QMainWindow):
             return
 
         layer = canvas.currentLayer
-        r, g, b, a = layer.pil_image.split()
-        newAlpha = ImageChops.subtract(a, canvas.selectionMask)
-        layer.pil_image = Image.merge("RGBA", (r, g, b, newAlpha))
-        layer.updatePixmap()
+        box = canvas.selectionBounds()
+        if box is None:
+            return
+        x0, y0, x1, y1 = box
+        layer.prepareWrite(box)
+        _, remaining = splitByMask(layer.pixels[y0:y1, x0:x1], canvas.selectionMask.region(box))
+        layer.pixels[y0:y1, x0:x1] = remaining
+        layer.updatePixmap(box)
         canvas.viewport().update()
         print("Selection cut.")
         
@@ -2732,36 +4094,46 @@ class MainWindow(QMainWindow):
         canvas = self.currentCanvas()
         if not canvas or not canvas.currentLayer:
             return
-        canvas.pushUndo("Flip Horizontal")
-
-        img = canvas.currentLayer.pil_image
         if canvas.selectionMask:
-            mask = canvas.selectionMask
-            region = Image.composite(img, Image.new("RGBA", img.size, (0,0,0,0)), mask)
-            region = region.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
-            canvas.currentLayer.pil_image.paste(region, (0, 0), mask)
+            box = canvas.selectionBounds()
+            if not box:
+                return
+            # The selection is mirrored in place about the centre of its bounding box
+            cx, cy = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+            transform = QTransform()
+            transform.translate(cx, cy)
+            transform.scale(-1, 1)
+            transform.translate(-cx, -cy)
+            canvas.transformSelection(transform, "Flip Horizontal")
         else:
-            canvas.currentLayer.pil_image = img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+            # A whole layer flip is its own inverse, so only the command is kept
+            flip = partial(canvas.flipLayer, canvas.currentLayer, Image.Transpose.FLIP_LEFT_RIGHT)
+            canvas.pushCommand("Flip Horizontal", flip, flip)
+            flip()
 
-        canvas.currentLayer.updatePixmap()
         canvas.viewport().update()
 
     def flipVertical(self):
         canvas = self.currentCanvas()
         if not canvas or not canvas.currentLayer:
             return
-        canvas.pushUndo("Flip Vertical")
-
-        img = canvas.currentLayer.pil_image
         if canvas.selectionMask:
-            mask = canvas.selectionMask
-            region = Image.composite(img, Image.new("RGBA", img.size, (0,0,0,0)), mask)
-            region = region.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
-            canvas.currentLayer.pil_image.paste(region, (0, 0), mask)
+            box = canvas.selectionBounds()
+            if not box:
+                return
+            # The selection is mirrored in place about the centre of its bounding box
+            cx, cy = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+            transform = QTransform()
+            transform.translate(cx, cy)
+            transform.scale(1, -1)
+            transform.translate(-cx, -cy)
+            canvas.transformSelection(transform, "Flip Vertical")
         else:
-            canvas.currentLayer.pil_image = img.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+            # A whole layer flip is its own inverse, so only the command is kept
+            flip = partial(canvas.flipLayer, canvas.currentLayer, Image.Transpose.FLIP_TOP_BOTTOM)
+            canvas.pushCommand("Flip Vertical", flip, flip)
+            flip()
 
-        canvas.currentLayer.updatePixmap()
         canvas.viewport().update()
     
 
@@ -2816,46 +4188,18 @@ class MainWindow(QMainWindow):
         if not canvas or not canvas.currentLayer:
             return
 
-        canvas.pushUndo("Shear Transform")
-
-        img = canvas.currentLayer.pil_image
-        mask = canvas.selectionMask
-
-        if mask:
-            region = Image.composite(img, Image.new("RGBA", img.size, (0,0,0,0)), mask)
-            bbox = mask.getbbox()
-        else:
-            region = img
-            bbox = region.getbbox()
-
+        bbox = canvas.selectionBounds() if canvas.selectionMask else canvas.currentLayer.pil_image.getbbox()
         if bbox is None:
             print("Nothing to shear.")
             return
 
-        region = region.crop(bbox)
-        width, height = region.size
-
-        shearMatrix = (1, xShear, 0, yShear, 1, 0)
-
-        sheared = region.transform(
-            (int(width + abs(xShear) * height), int(height + abs(yShear) * width)), Image.Transform.AFFINE, shearMatrix, resample=Image.LANCZOS)
-
-        # Clear the original region (using a cropped transparent mask)
-        output = img.copy()
-        if mask:
-            # Clear original selected area
-            cropMask = mask.crop(bbox)
-            output.paste(Image.new("RGBA", cropMask.size, (0, 0, 0, 0)), bbox, cropMask)
-        else:
-            # Clear the entire bounding box area
-            clearBox = Image.new("RGBA", (bbox[2]-bbox[0], bbox[3]-bbox[1]), (0, 0, 0, 0))
-            output.paste(clearBox, (bbox[0], bbox[1]))
-
-        # Paste the sheared result
-        output.paste(sheared, (bbox[0], bbox[1]), sheared)
-
-        canvas.currentLayer.pil_image = output
-        canvas.currentLayer.updatePixmap()
+        # Each output pixel (x, y) in the box takes the pixel at (x + xShear * y, yShear * x + y)
+        shear, invertible = QTransform(1, yShear, xShear, 1, 0, 0).inverted()
+        if not invertible:
+            print("Shear cannot be applied, it flattens the image.")
+            return
+        transform = QTransform.fromTranslate(-bbox[0], -bbox[1]) * shear * QTransform.fromTranslate(bbox[0], bbox[1])
+        canvas.transformSelection(transform, "Shear Transform")
         canvas.viewport().update()
 
         
@@ -0,0 +1,110 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+pytest.importorskip("PyQt6")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from PyQt6.QtWidgets import QApplication
+
+import Main
+from Main import Canvas, Layer, OutlineService, SelectionMask, splitByMask
+
+@pytest.fixture(scope="module")
+def app():
+    return QApplication.instance() or QApplication([])
+
+def softSelection(size):
+    """
+    Returns a fully selected square ringed by a partly selected edge
+    """
+    local = np.full((8, 8), 191, dtype=np.uint8)
+    local[1:-1, 1:-1] = 255
+    return SelectionMask(size, local, (4, 4))
+
+def test_split_keeps_colour_and_shares_alpha():
+    pixels = np.full((1, 3, 4), 255, dtype=np.uint8)
+    pixels[0, 2, 3] = 100
+    selected, remaining = splitByMask(pixels, np.array([[255, 191, 64]], dtype=np.uint8))
+    assert (selected[..., :3] == 255).all()
+    assert (remaining[0, 1:, :3] == 255).all()
+    assert selected[0, :, 3].tolist() == [255, 191, 25]
+    assert (selected[..., 3].astype(int) + remaining[..., 3] == pixels[..., 3]).all()
+
+def test_moving_soft_selection_leaves_no_dark_fringe(app):
+    canvas = Canvas(sceneWidth=24, sceneHeight=24)
+    layer = Layer("White", Image.new("RGBA", (24, 24), (255, 255, 255, 255)))
+    canvas.addLayer(layer)
+    canvas.currentLayer = layer
+    canvas.selectionMask = softSelection((24, 24))
+
+    canvas.liftSelection(preview=False)
+    canvas.selectionDragOffset = (6, 0)
+    canvas.dropSelection()
+
+    visible = layer.pixels[layer.pixels[..., 3] > 0]
+    assert (visible[:, :3] == 255).all()
+    # The partly selected edge leaves its unselected share behind, still white
+    assert tuple(layer.pixels[4, 4]) == (255, 255, 255, 64)
+
+def test_select_all_colour_ignores_alpha(app):
+    canvas = Canvas(sceneWidth=8, sceneHeight=8)
+    layer = Layer("Red", Image.new("RGBA", (8, 8), (0, 0, 0, 0)))
+    layer.pixels[1, 1] = (200, 0, 0, 255)
+    layer.pixels[5, 5] = (200, 0, 0, 80)
+    layer.pixels[6, 6] = (0, 0, 200, 255)
+    canvas.addLayer(layer)
+    canvas.currentLayer = layer
+    canvas.wandAntiAlias = False
+
+    canvas.selectAllColour((200, 0, 0, 255))
+
+    assert canvas.selectionMask.getpixel((1, 1)) == 255
+    assert canvas.selectionMask.getpixel((5, 5)) == 255
+    assert canvas.selectionMask.getpixel((6, 6)) == 0
+
+def test_alpha_plane_released_when_no_longer_clipped_to(app):
+    canvas = Canvas(sceneWidth=8, sceneHeight=8)
+    base = Layer("Base", Image.new("RGBA", (8, 8), (255, 255, 255, 128)))
+    top = Layer("Top", Image.new("RGBA", (8, 8), (0, 0, 0, 0)))
+    canvas.addLayer(base)
+    canvas.addLayer(top)
+    top.clippingMaskEnabled = True
+
+    plane = base.alphaPlane()
+    assert plane.dtype == np.uint8 and plane.flags.c_contiguous
+    canvas.releaseAlphaPlanes()
+    assert base.alphaCache is not None
+
+    top.clippingMaskEnabled = False
+    canvas.releaseAlphaPlanes()
+    assert base.alphaCache is None
+
+def test_failed_outline_trace_is_no_longer_pending(app, monkeypatch):
+    def failing(mask, epsilon):
+        raise ValueError("trace failed")
+    monkeypatch.setattr(Main, "buildOutline", failing)
+    service = OutlineService()
+    mask = softSelection((24, 24))
+    key = (mask.version, 1.0)
+    service.pending.add(key)
+
+    service.trace(mask, key)
+
+    assert key not in service.pending
+    assert key not in service.cache
+
+def test_outline_not_redrawn_during_handle_drag(app):
+    canvas = Canvas(sceneWidth=24, sceneHeight=24)
+    canvas.setSelectionMask(softSelection((24, 24)))
+    item = canvas.selectionItem
+    canvas.currentHandle = 0
+
+    canvas.onOutlineReady((canvas.selectionMask.version, canvas.outlineEpsilon))
+
+    assert canvas.selectionItem is item